@@ -0,0 +1,99 @@
+# This file is part of Guardian.
+#
+# Guardian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Guardian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Guardian. If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmark of the Latex post-processing. It compares the single-pass PostProcessor with the previous
+implementation, which applied each rule with re.sub, and verifies that both produce the same output.
+
+Usage (from the app directory): python -m benchmarks.post_processing [--fragments 2000] [--repeat 5]
+"""
+
+import re
+import random
+import argparse
+import timeit
+from typing import List
+from report.postprocessing import PostProcessor
+
+__author__ = "Lukas Reiter"
+__copyright__ = "Copyright (C) 2024 Lukas Reiter"
+__license__ = "GPLv3"
+
+RE_NUMBERING = {
+    r"([\s234567890]1)(st)": "\\1$^{st}$",
+    r"([\s234567890]2)(nd)": "\\1$^{nd}$",
+    r"([\s234567890]3)(rd)": "\\1$^{nd}$",
+    r"((\s11)|(\s12)|(\s13)|([4567890]))(th)": "\\1$^{th}$"
+}
+
+FRAGMENTS = [
+    "The application does not validate the \\texttt{redirect} parameter. See \\href{https://owasp.org/Top10/}{OWASP "
+    "Top 10} for more information.",
+    "On the 1st, 2nd and 3rd of March as well as on the 11th, 12th, 13th and 24th of April, the 21st test run "
+    "failed.",
+    "\\begin{itemize}\n\\item Update the library to the latest version.\n\\item See \\href\n{https://cwe.mitre.org/}"
+    "{CWE}.\n\\end{itemize}",
+    "The 101st request returned the session cookie \\texttt{JSESSIONID} without the \\texttt{HttpOnly} flag, "
+    "whereas the 42nd and the 53rd did not.",
+    "\\textbf{Note:} Most of the findings were identified with the tester's 5th and 6th accounts.",
+    "Pandoc generated \\url{https://example.com/first} and \\href  {https://example.com/second}{second}.",
+]
+
+
+def legacy(content: str) -> str:
+    """
+    The implementation of ReportCreatorBase.post_processing_func before the PostProcessor was introduced.
+    """
+    result = re.sub("\\\\href[\\s\\n]*\\{", "\\\\slink{", content)
+    for pattern, repl in RE_NUMBERING.items():
+        result = re.sub(pattern=pattern, repl=repl, string=result)
+    for pattern, repl in RE_NUMBERING.items():
+        result = re.sub(pattern=pattern, repl=repl, string=result)
+    return result
+
+
+def get_corpus(count: int, seed: int = 0) -> List[str]:
+    """
+    Returns realistic fragments as well as random fragments that consist of ordinals, href commands and whitespace.
+    """
+    generator = random.Random(seed)
+    tokens = [
+        "1", "2", "3", "4", "11", "12", "13", "0", "st", "nd", "rd", "th", " ", "\n", "\t", "\\href", "{", "}", "a",
+        "$^{st}$", "\\href \n{"
+    ]
+    result = [generator.choice(FRAGMENTS) for _ in range(count)]
+    result += ["".join(generator.choice(tokens) for _ in range(generator.randint(1, 40))) for _ in range(count)]
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fragments", type=int, default=2000, help="number of realistic and random fragments")
+    parser.add_argument("--repeat", type=int, default=5, help="number of timed runs")
+    args = parser.parse_args()
+    processor = PostProcessor()
+    corpus = get_corpus(args.fragments)
+    for fragment in corpus:
+        expected = legacy(fragment)
+        actual = processor.process(fragment)
+        assert expected == actual, f"output differs for {fragment!r}: {expected!r} != {actual!r}"
+    print(f"Output of {len(corpus)} fragments is identical.")
+    for name, function in [("legacy", legacy), ("single-pass", processor.process)]:
+        duration = min(timeit.repeat(lambda: [function(item) for item in corpus], number=1, repeat=args.repeat))
+        print(f"{name:>12}: {duration * 1000:8.2f} ms ({duration / len(corpus) * 1000000:.2f} us per fragment)")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,7 @@
 # along with Guardian. If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import tempfile
 from dotenv import load_dotenv
 from pathlib import Path
 from schema import SettingsBase
@@ -36,26 +37,89 @@ class Settings(SettingsBase):
     def __init__(self):
         super().__init__()
         self.data_directory = os.getenv("DATA_DIRECTORY")
+        self.cache_directory = os.getenv(
+            "CACHE_DIRECTORY",
+            os.path.join(tempfile.gettempdir(), "guardian-reporting")
+        )
         self.latex_template_directory = os.getenv("LATEX_TEMPLATE_DIRECTORY")
         self.latex_template_file = os.getenv("LATEX_TEMPLATE_FILE")
+        # Number of seconds after which the Latex template directories are checked for changes again
+        self.template_check_interval = int(os.getenv("TEMPLATE_CHECK_INTERVAL", 60))
         self.latex_command_whitelist = sorted([
             item.strip().lower() for item in os.getenv("LATEX_COMMAND_WHITELIST", "").split(",")
         ])
         self.worker_threads = int(os.getenv("WORKER_THREADS", 1))
+        # Number of threads executing blocking report stages (file operations, pandoc, openpyxl, database commits)
+        self.blocking_workers = int(os.getenv("BLOCKING_WORKERS", os.cpu_count() or 1))
+        # Report requests are either consumed from a Redis stream (stream) or a Redis channel (pubsub). The channel stays
+        # the default until all producers add their requests to the stream.
+        self.report_queue = os.getenv("REPORT_QUEUE", "pubsub").lower()
+        self.redis_stream_host = os.getenv("REDIS_HOST", "localhost")
+        self.redis_stream_port = int(os.getenv("REDIS_PORT", 6379))
+        self.redis_stream_use_ssl = os.getenv("REDIS_USE_SSL", "false").lower() == "true"
+        self.redis_stream_ca_file = os.getenv("REDIS_CA_FILE")
+        self.redis_report_stream = os.getenv("REDIS_REPORT_STREAM", "stream:report")
+        self.redis_report_group = os.getenv("REDIS_REPORT_GROUP", "reporting")
+        self.redis_report_block_timeout = int(os.getenv("REDIS_REPORT_BLOCK_TIMEOUT", 5))
+        self.redis_report_reclaim_idle = int(os.getenv("REDIS_REPORT_RECLAIM_IDLE", 300))
+        self.redis_report_max_deliveries = int(os.getenv("REDIS_REPORT_MAX_DELIVERIES", 3))
         self.excel_template_file = os.getenv("EXCEL_TEMPLATE_FILE")
         self.excel_sheet_name = os.getenv("EXCEL_TEMPLATE_SHEET")
         self.excel_table_name = os.getenv("EXCEL_TABLE_NAME")
         self.excel_template_row = int(os.getenv("EXCEL_TEMPLATE_ROW", 2))
+        # The Excel file is either created with openpyxl (openpyxl) or by streaming into the template's XML (stream)
+        self.excel_engine = os.getenv("EXCEL_ENGINE", "openpyxl").lower()
+        # Number of seconds the CWE categories are cached in memory (0 disables the cache)
+        self.cwe_cache_timeout = int(os.getenv("CWE_CACHE_TIMEOUT", 3600))
+        # If true, progress notifications are coalesced and published in the background
+        self.notification_buffering = os.getenv("NOTIFICATION_BUFFERING", "true").lower() == "true"
+        # Maximum number of progress notifications per second and requestor (0 disables the limit)
+        self.notification_rate = float(os.getenv("NOTIFICATION_RATE", 2))
         self.report_classification = os.getenv("REPORT_CLASSIFICATION", "")
         self.pandoc_arguments = os.getenv("PANDOC_ARGUMENTS", "").split()
+        self.pandoc_batch_conversion = os.getenv("PANDOC_BATCH_CONVERSION", "true").lower() == "true"
+        # Maximum number of pandoc processes running concurrently per job
+        self.pandoc_processes = int(os.getenv("PANDOC_PROCESSES", 4))
+        # Sizes of the pandoc conversion cache in MB (0 disables the respective cache level)
+        self.pandoc_cache_size = int(os.getenv("PANDOC_CACHE_SIZE", 256)) * 1024 * 1024
+        self.pandoc_cache_memory_size = int(os.getenv("PANDOC_CACHE_MEMORY_SIZE", 32)) * 1024 * 1024
+        # If false, the Latex ZIP archive only contains the generated files and images but not the template files
+        self.latex_zip_include_template = os.getenv("LATEX_ZIP_INCLUDE_TEMPLATE", "true").lower() == "true"
+        self.latex_zip_compression_level = int(os.getenv("LATEX_ZIP_COMPRESSION_LEVEL", 6))
+        # If true, the Latex package only defines the placeholder commands used by the template or the generated files
+        self.latex_package_referenced_only = os.getenv("LATEX_PACKAGE_REFERENCED_ONLY", "true").lower() == "true"
+        # If true, created files are streamed in chunks (MB) into the database instead of being loaded into memory
+        self.artifact_streaming = os.getenv("ARTIFACT_STREAMING", "true").lower() == "true"
+        self.artifact_chunk_size = int(os.getenv("ARTIFACT_CHUNK_SIZE", 4)) * 1024 * 1024
+        # Sizes of the avatar thumbnail cache in MB
+        self.avatar_cache_size = int(os.getenv("AVATAR_CACHE_SIZE", 32)) * 1024 * 1024
+        self.avatar_cache_memory_size = int(os.getenv("AVATAR_CACHE_MEMORY_SIZE", 8)) * 1024 * 1024
+        # Images are downscaled to the maximum printed width (in mm) at the given resolution (in DPI)
+        self.image_optimization = os.getenv("IMAGE_OPTIMIZATION", "true").lower() == "true"
+        self.image_max_width = float(os.getenv("IMAGE_MAX_WIDTH", 170))
+        self.image_dpi = int(os.getenv("IMAGE_DPI", 300))
+        self.image_jpeg_quality = int(os.getenv("IMAGE_JPEG_QUALITY", 90))
+        self.image_workers = int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 1))
+        # Size of the store in MB holding the (prepared) images of previous jobs (0 disables the store)
+        self.image_store_size = int(os.getenv("IMAGE_STORE_SIZE", 512)) * 1024 * 1024
         self.pdflatex_file = os.getenv("PDFLATEX_FILE")
         self.pdflatex_arguments = os.getenv("PDFLATEX_ARGUMENTS", "").split()
         self.pdflatex_timeout = int(os.getenv("PDFLATEX_EXECUTION_TIMEOUT"), 30)
         self.pdflatex_iterations = int(os.getenv("PDFLATEX_EXECUTION_TIMES", 3))
+        # Number of vulnerabilities of a single request, which are created concurrently
+        self.vulnerability_concurrency = int(os.getenv("VULNERABILITY_CONCURRENCY", 4))
+        # If true, multiple vulnerabilities of a single request are compiled into one document, which is then split
+        self.vulnerability_single_document = os.getenv("VULNERABILITY_SINGLE_DOCUMENT", "false").lower() == "true"
+        self.pdflatex_precompile_format = os.getenv("PDFLATEX_PRECOMPILE_FORMAT", "true").lower() == "true"
+        # Size of the cache in MB holding the auxiliary files of previous builds (0 disables seeding)
+        self.pdflatex_seed_cache_size = int(os.getenv("PDFLATEX_SEED_CACHE_SIZE", 64)) * 1024 * 1024
         self.cvss_base_url = os.getenv("CVSS_BASE_URL", "https://www.first.org/cvss/calculator/3.1")
         self.cvss_version = os.path.basename(self.cvss_base_url)
         self.cvss_definitions_url = os.getenv("CWE_DEFINITIONS_URL")
 
+    def get_cache_directory(self, name: str) -> str:
+        return os.path.join(self.cache_directory, name)
+
     def get_latex_template_directory(self, version: ReportTemplateFileVersion) -> str:
         return os.path.join(self.data_directory, version.name, self.latex_template_directory)
 
@@ -0,0 +1,168 @@
+# This file is part of Guardian.
+#
+# Guardian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Guardian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Guardian. If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+from typing import Awaitable, Callable, List, Tuple
+from redis import asyncio as aioredis
+from redis.exceptions import ResponseError
+from core.config import Settings
+
+__author__ = "Lukas Reiter"
+__copyright__ = "Copyright (C) 2024 Lukas Reiter"
+__license__ = "GPLv3"
+
+logger = logging.getLogger(__name__)
+
+
+class StreamConsumer:
+    """
+    This class consumes report requests from a Redis stream using a consumer group. Each message is delivered to
+    exactly one consumer of the group and acknowledged once it has been processed. Messages of consumers that died
+    while processing them are reclaimed by the remaining consumers.
+    """
+    def __init__(
+            self,
+            settings: Settings,
+            consumer_name: str,
+            username: str,
+            password: str,
+            callback: Callable[[str], Awaitable[None]]
+    ):
+        self.settings = settings
+        self.stream = settings.redis_report_stream
+        self.group = settings.redis_report_group
+        self.consumer_name = consumer_name
+        self.callback = callback
+        self.reclaim_idle_ms = settings.redis_report_reclaim_idle * 1000
+        self.max_deliveries = settings.redis_report_max_deliveries
+        self._redis = aioredis.Redis(
+            host=settings.redis_stream_host,
+            port=settings.redis_stream_port,
+            username=username,
+            password=password,
+            ssl=settings.redis_stream_use_ssl,
+            ssl_ca_certs=settings.redis_stream_ca_file,
+            decode_responses=True
+        )
+
+    async def create_group(self):
+        """
+        Creates the consumer group (and the stream), if it does not exist yet.
+        """
+        try:
+            await self._redis.xgroup_create(name=self.stream, groupname=self.group, id="0", mkstream=True)
+            logger.info(f"Created consumer group '{self.group}' for stream '{self.stream}'.")
+        except ResponseError as ex:
+            if "BUSYGROUP" not in str(ex):
+                raise
+
+    async def run(self):
+        """
+        Processes messages until the task is cancelled.
+        """
+        await self.create_group()
+        # After a restart, we first process the messages, which were delivered to us but never acknowledged.
+        while messages := await self._read(message_id="0"):
+            await self._process(messages)
+        while True:
+            await self._process(await self._reclaim())
+            await self._process(await self._read(message_id=">"))
+
+    async def _read(self, message_id: str) -> List[Tuple[str, dict]]:
+        """
+        Reads new (message_id=">") or own pending (message_id="0") messages.
+        """
+        response = await self._redis.xreadgroup(
+            groupname=self.group,
+            consumername=self.consumer_name,
+            streams={self.stream: message_id},
+            count=1,
+            block=self.settings.redis_report_block_timeout * 1000 if message_id == ">" else None
+        )
+        return [message for _, messages in response or [] for message in messages]
+
+    async def _reclaim(self) -> List[Tuple[str, dict]]:
+        """
+        Takes over messages of other consumers that have been pending for too long.
+        """
+        response = await self._redis.xautoclaim(
+            name=self.stream,
+            groupname=self.group,
+            consumername=self.consumer_name,
+            min_idle_time=self.reclaim_idle_ms,
+            start_id="0-0",
+            count=1
+        )
+        messages = [item for item in response[1] if item and item[1] is not None]
+        for message_id, _ in messages:
+            logger.warning(f"Reclaimed pending message '{message_id}' from stream '{self.stream}'.")
+        return messages
+
+    async def _get_delivery_count(self, message_id: str) -> int:
+        """
+        Returns how often the given message has been delivered.
+        """
+        pending = await self._redis.xpending_range(
+            name=self.stream,
+            groupname=self.group,
+            min=message_id,
+            max=message_id,
+            count=1
+        )
+        return pending[0]["times_delivered"] if pending else 0
+
+    async def _heartbeat(self, message_id: str):
+        """
+        Resets the idle time of the given message while it is being processed, so that long-running jobs are not
+        reclaimed by other consumers.
+        """
+        interval = max(self.settings.redis_report_reclaim_idle / 3, 1)
+        while True:
+            await asyncio.sleep(interval)
+            await self._redis.xclaim(
+                name=self.stream,
+                groupname=self.group,
+                consumername=self.consumer_name,
+                min_idle_time=0,
+                message_ids=[message_id],
+                justid=True
+            )
+
+    async def _process(self, messages: List[Tuple[str, dict]]):
+        """
+        Processes and acknowledges the given messages.
+        """
+        for message_id, fields in messages:
+            if not fields:
+                # The message was deleted from the stream in the meantime.
+                await self._redis.xack(self.stream, self.group, message_id)
+                continue
+            deliveries = await self._get_delivery_count(message_id)
+            if deliveries > self.max_deliveries:
+                logger.error(f"Dropping message '{message_id}' after {deliveries} deliveries.")
+                await self._redis.xack(self.stream, self.group, message_id)
+                continue
+            heartbeat = asyncio.create_task(self._heartbeat(message_id))
+            try:
+                await self.callback(fields.get("data"))
+            except Exception as ex:
+                logger.exception(ex)
+            finally:
+                heartbeat.cancel()
+            await self._redis.xack(self.stream, self.group, message_id)
+
+    async def close(self):
+        await self._redis.aclose()
@@ -13,12 +13,14 @@
 # You should have received a copy of the GNU General Public License
 # along with Guardian. If not, see <https://www.gnu.org/licenses/>.
 
+import socket
 import asyncio
 from io import StringIO
 from dotenv import load_dotenv
 # We specify the environment to be used.
 load_dotenv(stream=StringIO("ENV=prod"))
 from core.config import settings
+from core.stream import StreamConsumer
 from schema.database.redis_client import subscribe as redis_subscribe
 from report.core import process_json, check_setup
 # We set up the logging configuration
@@ -31,18 +33,32 @@ __license__ = "GPLv3"
 logger = logging.getLogger(__name__)
 
 
-async def consume_messages():
+async def consume_messages(worker_id: int):
     """
-    Consumes and processes messages from the RabbitMQ server.
+    Consumes and processes messages from the Redis server.
     """
     logger.info(f"Waiting for messages...")
     try:
-        await redis_subscribe(
-            username=settings.redis_user_report_read,
-            password=settings.redis_password_report_read,
-            channel=settings.redis_report_channel,
-            callback=process_json
-        )
+        if settings.report_queue == "stream":
+            # The consumer name must be stable across restarts, so that we can resume our pending messages.
+            consumer = StreamConsumer(
+                settings=settings,
+                consumer_name=f"{socket.gethostname()}-{worker_id}",
+                username=settings.redis_user_report_read,
+                password=settings.redis_password_report_read,
+                callback=process_json
+            )
+            try:
+                await consumer.run()
+            finally:
+                await consumer.close()
+        else:
+            await redis_subscribe(
+                username=settings.redis_user_report_read,
+                password=settings.redis_password_report_read,
+                channel=settings.redis_report_channel,
+                callback=process_json
+            )
     except Exception as ex:
         logger.exception(ex)
 
@@ -51,7 +67,7 @@ async def main():
     # Check if configuration is correct
     check_setup()
     # Start worker threads
-    tasks = [consume_messages() for _ in range(settings.worker_threads)]
+    tasks = [consume_messages(i) for i in range(settings.worker_threads)]
     # Await the completion of all tasks
     await asyncio.gather(*tasks)
 
@@ -0,0 +1,91 @@
+# This file is part of Guardian.
+#
+# Guardian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Guardian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Guardian. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import logging
+from typing import Any, BinaryIO
+from sqlalchemy import inspect, update, select, func
+from sqlalchemy.orm import Session
+from core.config import Settings
+
+__author__ = "Lukas Reiter"
+__copyright__ = "Copyright (C) 2024 Lukas Reiter"
+__license__ = "GPLv3"
+
+logger = logging.getLogger(__name__)
+
+
+class ArtifactWriter:
+    """
+    This class stores created files (PDF, Excel, ZIP, log files) in the binary columns of the database.
+
+    The files are streamed in chunks into a PostgreSQL large object, which is then copied into the column on the
+    database server. Thus, the memory consumption of a job is bounded by the chunk size, no matter how large the file
+    is. For other databases, the files are read into memory and assigned to the column.
+    """
+    def __init__(self, session: Session, settings: Settings):
+        self.session = session
+        self.chunk_size = settings.artifact_chunk_size
+        self.streaming = settings.artifact_streaming and session.get_bind().dialect.name == "postgresql"
+
+    def write(self, instance: Any, attribute: str, source: str | BinaryIO | None):
+        """
+        Stores the given file in the given attribute of the given database object.
+
+        :param instance: the database object (e.g., ReportVersion or Vulnerability).
+        :param attribute: str, the name of the binary column.
+        :param source: the path or the binary file object, whose content is stored. If the path does not exist or
+        source is None, the column is cleared.
+        """
+        if source is None or (isinstance(source, str) and not os.path.isfile(source)):
+            setattr(instance, attribute, None)
+            return
+        if isinstance(source, str):
+            with open(source, "rb") as file:
+                self._write(instance, attribute, file)
+        else:
+            source.seek(0)
+            self._write(instance, attribute, source)
+
+    def _write(self, instance: Any, attribute: str, file: BinaryIO):
+        """
+        Stores the content of the given file object.
+        """
+        if not self.streaming:
+            setattr(instance, attribute, file.read())
+            return
+        # Pending changes must be flushed first, so that the subsequent update is not overwritten by them.
+        self.session.flush()
+        connection = self.session.connection().connection.dbapi_connection
+        large_object = connection.lobject(0, "wb")
+        try:
+            while chunk := file.read(self.chunk_size):
+                large_object.write(chunk)
+        finally:
+            large_object.close()
+        state = inspect(instance)
+        mapper = state.mapper
+        # The identity is known without loading the instance. Loading an expired instance (e.g., after a commit) would
+        # fetch the previously stored files into memory.
+        primary_key = state.identity or mapper.primary_key_from_instance(instance)
+        self.session.execute(
+            update(mapper.local_table)
+            .where(*[column == value for column, value in zip(mapper.primary_key, primary_key)])
+            .values({mapper.columns[attribute].name: func.lo_get(large_object.oid)})
+        )
+        # If anything fails before, the large object is discarded together with the rolled back transaction.
+        self.session.execute(select(func.lo_unlink(large_object.oid)))
+        # The ORM must neither keep nor write back a stale value.
+        self.session.expire(instance, [attribute])
@@ -0,0 +1,236 @@
+# This file is part of Guardian.
+#
+# Guardian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Guardian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Guardian. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+__author__ = "Lukas Reiter"
+__copyright__ = "Copyright (C) 2024 Lukas Reiter"
+__license__ = "GPLv3"
+
+logger = logging.getLogger(__name__)
+
+
+class FileCache:
+    """
+    This class implements a content-addressed cache. Entries are stored on disk and the most recently used ones are
+    additionally kept in memory. Both levels are size-bounded and evict the least recently used entries first.
+    """
+    def __init__(self, directory: str | None, max_size: int, max_memory_size: int = 0):
+        """
+        :param directory: str, the directory where the entries are stored. If None, only the memory cache is used.
+        :param max_size: int, the maximum size of the disk cache in bytes.
+        :param max_memory_size: int, the maximum size of the memory cache in bytes.
+        """
+        self.directory = directory if max_size > 0 else None
+        self.max_size = max_size
+        self.max_memory_size = max_memory_size
+        self._memory = OrderedDict()
+        self._memory_size = 0
+        self._size = None
+        self._lock = threading.Lock()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def get_key(*parts: str | bytes) -> str:
+        """
+        Returns the cache key for the given parts.
+        """
+        result = hashlib.sha256()
+        for part in parts:
+            result.update(part.encode("utf-8") if isinstance(part, str) else part)
+            result.update(b"\0")
+        return result.hexdigest()
+
+    def get_path(self, key: str) -> str | None:
+        """
+        Returns the path of the given entry on disk or None, if the entry does not exist.
+        """
+        if not self.directory:
+            return None
+        path = self._get_path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            # We use the modification time to track the least recently used entries.
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def get(self, key: str) -> bytes | None:
+        """
+        Returns the content of the given entry or None, if the entry does not exist.
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        if not (path := self.get_path(key)):
+            return None
+        try:
+            with open(path, "rb") as file:
+                result = file.read()
+        except OSError:
+            return None
+        self._put_memory(key, result)
+        return result
+
+    def put(self, key: str, content: bytes, replace: bool = False):
+        """
+        Adds the given content to the cache.
+
+        :param key: str, the key of the entry.
+        :param content: bytes, the content of the entry.
+        :param replace: bool, if True, an existing entry is overwritten. This is only necessary for keys that are not
+        derived from the content.
+        """
+        if replace:
+            self._remove_memory(key)
+        self._put_memory(key, content)
+        if not self.directory:
+            return
+        path = self._get_path(key)
+        previous_size = 0
+        if os.path.isfile(path):
+            if not replace:
+                return
+            previous_size = os.stat(path).st_size
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # We write to a temporary file first, so that concurrent readers never see partial entries.
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as file:
+                file.write(content)
+            os.replace(file.name, path)
+        except OSError as ex:
+            logger.exception(ex)
+            return
+        with self._lock:
+            if self._size is not None:
+                self._size += len(content) - previous_size
+        self._evict()
+
+    def link(self, key: str, destination: str) -> bool:
+        """
+        Creates the given file with the content of the given entry. If possible, the file is a hard link to the entry
+        on disk, so that its content is not written again.
+
+        :return: bool, False, if the entry does not exist.
+        """
+        path = self.get_path(key)
+        content = None if path else self.get(key)
+        if not path and content is None:
+            return False
+        if os.path.lexists(destination):
+            # We must not write into an existing file, as it might be a hard link to another entry.
+            os.remove(destination)
+        if path:
+            try:
+                os.link(path, destination)
+                return True
+            except OSError:
+                content = self.get(key)
+                if content is None:
+                    return False
+        with open(destination, "wb") as file:
+            file.write(content)
+        return True
+
+    def put_file(self, key: str, source: str):
+        """
+        Adds the content of the given file to the cache.
+        """
+        with open(source, "rb") as file:
+            self.put(key, file.read())
+
+    def _get_path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _remove_memory(self, key: str):
+        """
+        Removes the given entry from the memory cache.
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory_size -= len(self._memory.pop(key))
+
+    def _put_memory(self, key: str, content: bytes):
+        """
+        Adds the given content to the memory cache.
+        """
+        if len(content) > self.max_memory_size:
+            return
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return
+            self._memory[key] = content
+            self._memory_size += len(content)
+            while self._memory_size > self.max_memory_size:
+                _, value = self._memory.popitem(last=False)
+                self._memory_size -= len(value)
+
+    def _evict(self):
+        """
+        Removes the least recently used entries from disk until the cache is below its maximum size.
+        """
+        with self._lock:
+            if self._size is not None and self._size <= self.max_size:
+                return
+            entries = []
+            for root, _, files in os.walk(self.directory):
+                for file in files:
+                    path = os.path.join(root, file)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+            self._size = sum(item[1] for item in entries)
+            if self._size <= self.max_size:
+                return
+            # We evict down to 90% of the maximum size to avoid evicting on every insert.
+            for _, size, path in sorted(entries):
+                if self._size <= self.max_size * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                    self._size -= size
+                except OSError:
+                    pass
+            logger.debug(f"Evicted cache entries in '{self.directory}'. Current size: {self._size} bytes.")
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(directory: str | None, max_size: int, max_memory_size: int = 0) -> FileCache:
+    """
+    Returns the process-wide cache instance for the given directory.
+    """
+    with _caches_lock:
+        if directory not in _caches:
+            _caches[directory] = FileCache(
+                directory=directory,
+                max_size=max_size,
+                max_memory_size=max_memory_size
+            )
+        return _caches[directory]
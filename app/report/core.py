@@ -16,9 +16,11 @@
 import os
 import json
 import shutil
+import asyncio
 import logging
 import pathlib
 import tempfile
+from typing import BinaryIO, Callable, Dict, List
 from core.config import settings
 from report import notify_user
 from schema import SessionLocal
@@ -30,6 +32,12 @@ from .pdf import ReportCreator as PdfReportCreator
 from .excel import ReportCreator as ExcelReportCreator
 from .latex import ReportCreator as LatexReportCreator
 from .latex import VulnerabilityCreator as LatexVulnerabilityCreator
+from .latex import VulnerabilitiesCreator as LatexVulnerabilitiesCreator
+from .cache import FileCache
+from .artifact import ArtifactWriter
+from .template import TemplateBundle, get_template_bundle, remove_outdated_snapshots
+from .executor import run_blocking
+from .notification import NotificationPublisher
 from sqlalchemy import and_
 from sqlalchemy.orm import Session
 
@@ -47,6 +55,8 @@ def check_setup():
     PdfReportCreator.check(settings)
     LatexReportCreator.check(settings)
     ExcelReportCreator.check(settings)
+    # Snapshots of outdated template directories are only removed at startup, when no job uses them.
+    remove_outdated_snapshots(settings)
 
 
 async def process_report_creation(
@@ -54,10 +64,13 @@ async def process_report_creation(
         images_dir: str,
         work_dir: str,
         logger: logging.Logger,
-        info: ReportGenerationInfo
+        info: ReportGenerationInfo,
+        publisher: NotificationPublisher
 ):
     """
     Processes the report creation.
+
+    :param publisher: NotificationPublisher, buffers and publishes the progress notifications of the job.
     """
     async def notify(
         **kwargs
@@ -65,178 +78,404 @@ async def process_report_creation(
         """
         Helper function for notifying the user about the report creation progress.
         """
-        await notify_user(
-            requestor=info.requestor,
-            **kwargs
-        )
+        await publisher.notify(**kwargs)
 
     report_id = info.project.report.id
     if info.type == ReportRequestType.report:
         report_version_id = info.project.report.versions[-1].version
         query_key = ["report", {"report": str(report_id)}, "overview", "version"]
-        report_version = session.query(ReportVersion) \
-            .join(Report) \
+        report_version = await run_blocking(
+            session.query(ReportVersion)
+            .join(Report)
             .filter(and_(
                 Report.id == report_id,
                 ReportVersion.version == report_version_id
-            )
-        ).one()
+            )).one
+        )
         report_version.creation_status = ReportCreationStatus.generating
         await notify(
             message=f"Report creation started for version: v{report_version_id}.",
             status=ReportCreationStatus.generating,
             query_key=query_key
         )
-        session.commit()
-        # 1. Create Excel file
-        try:
-            with tempfile.NamedTemporaryFile(suffix=".xlsx") as excel_file:
-                creator = ExcelReportCreator(
+        await run_blocking(session.commit)
+        # The Excel file and the Latex/PDF files do not depend on each other. We therefore create them concurrently
+        # and commit each artifact as soon as it is ready. As both stages share the session, commits are serialized.
+        commit_lock = asyncio.Lock()
+        writer = ArtifactWriter(session=session, settings=settings)
+
+        async def commit(files: Dict[str, str | BinaryIO | None] | None = None, **values):
+            """
+            Helper function for updating the report version and committing the changes.
+
+            :param files: dict, maps binary columns to the files, whose content is streamed into them.
+            """
+            async with commit_lock:
+                for key, value in values.items():
+                    setattr(report_version, key, value)
+                for key, value in (files or {}).items():
+                    await run_blocking(writer.write, report_version, key, value)
+                await run_blocking(session.commit)
+
+        async def create_excel() -> bool:
+            """
+            Creates the Excel file.
+            """
+            try:
+                with tempfile.NamedTemporaryFile(suffix=".xlsx") as excel_file:
+                    creator = ExcelReportCreator(
+                        notify=notify,
+                        excel_file=excel_file.name,
+                        settings=settings,
+                        work_dir=work_dir,
+                        info=info
+                    )
+                    await run_blocking(creator.create)
+                    await commit(files={"xlsx": creator.excel_file})
+                await notify(
+                    message=f"Excel report was successfully created for version: v{report_version_id} ",
+                    status=ReportCreationStatus.generating,
+                    query_key=query_key
+                )
+                return True
+            except Exception as ex:
+                logger.exception(ex)
+                await notify(
+                    message=f"Excel report creation was unsuccessful for version: v{report_version_id}",
+                    status=ReportCreationStatus.generating,
+                    query_key=query_key
+                )
+            return False
+
+        async def create_pdf() -> bool:
+            """
+            Creates the Latex and PDF files.
+            """
+            result = True
+            pdf_creator = None
+            latex_creator = LatexReportCreator(
+                notify=notify,
+                settings=settings,
+                work_dir=work_dir,
+                images_dir=images_dir,
+                info=info
+            )
+            try:
+                await run_blocking(latex_creator.create)
+                with tempfile.TemporaryFile() as zip_file:
+                    await run_blocking(latex_creator.get_zip, target=zip_file)
+                    await commit(files={"tex": zip_file})
+                await notify(
+                    message=f"Latex files were successfully created for version: v{report_version_id}",
+                    status=ReportCreationStatus.generating,
+                    query_key=query_key
+                )
+            except Exception as ex:
+                result = False
+                logger.exception(ex)
+                await notify(
+                    message=f"PDF file creation failed for version: v{report_version_id}",
+                    status=ReportCreationStatus.generating,
+                    query_key=query_key
+                )
+            try:
+                # Create PDF report
+                pdf_creator = PdfReportCreator(
+                    title=f"version: v{report_version_id}",
                     notify=notify,
-                    excel_file=excel_file.name,
                     settings=settings,
+                    tex_file=latex_creator.tex_file,
+                    seed_key=f"report-{report_id}",
                     work_dir=work_dir,
                     info=info
                 )
-                creator.create()
-                report_version.xlsx = creator.get_xlsx()
-                session.commit()
+                await pdf_creator.create()
+                # We don't need the logs, if building was successful.
+                await commit(files={"pdf": pdf_creator.pdf_file}, pdf_log=None)
+                await notify(
+                    message=f"PDF file was successfully created for version: v{report_version_id}",
+                    status=ReportCreationStatus.generating,
+                    query_key=query_key
+                )
+                return result
+            except Exception as ex:
+                try:
+                    if pdf_creator:
+                        await commit(files={"pdf_log": pdf_creator.log_file})
+                except Exception as ex1:
+                    logger.exception(ex1)
+                logger.exception(ex)
+                await notify(
+                    message=f"PDF file creation failed for version: v{report_version_id}",
+                    status=ReportCreationStatus.generating,
+                    query_key=query_key
+                )
+            return False
+
+        # The stages only report their progress. The user receives a single terminal notification, which matches the
+        # stored creation status.
+        excel_successful, pdf_successful = await asyncio.gather(create_excel(), create_pdf())
+        status = ReportCreationStatus.successful if excel_successful and pdf_successful else ReportCreationStatus.failed
+        await commit(creation_status=status)
+        if status == ReportCreationStatus.successful:
+            message = f"Report was successfully created for version: v{report_version_id}"
+        else:
+            message = f"Report creation failed for version: v{report_version_id}"
+        await notify(
+            message=message,
+            status=status,
+            query_key=query_key
+        )
+    elif info.type == ReportRequestType.vulnerability:
+        template = await run_blocking(get_template_bundle, settings, info.project.report.version)
+        # Multiple vulnerabilities can be compiled into a single document, which is split afterward. If this fails,
+        # we fall back to creating each vulnerability separately.
+        if settings.vulnerability_single_document and len(info.vulnerabilities) > 1 and \
+                await process_vulnerabilities_creation(
+                    vulnerability_ids=info.vulnerabilities,
+                    images_dir=images_dir,
+                    work_dir=os.path.join(os.path.dirname(work_dir), "vulnerabilities"),
+                    template=template,
+                    logger=logger,
+                    info=info,
+                    notify=notify
+                ):
+            return
+        # Vulnerabilities are created concurrently, each in its own work directory and database session.
+        semaphore = asyncio.Semaphore(settings.vulnerability_concurrency)
+
+        async def create_vulnerability(vulnerability_id):
+            async with semaphore:
+                await process_vulnerability_creation(
+                    vulnerability_id=vulnerability_id,
+                    images_dir=images_dir,
+                    work_dir=os.path.join(os.path.dirname(work_dir), f"vulnerability-{vulnerability_id}"),
+                    template=template,
+                    logger=logger,
+                    info=info,
+                    notify=notify
+                )
+        # Each task handles its own errors. We nevertheless wait for all tasks, so that no task is still running in
+        # the work directory, when it is removed.
+        results = await asyncio.gather(
+            *[create_vulnerability(item) for item in info.vulnerabilities],
+            return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, Exception):
+                logger.error(result, exc_info=result)
+
+
+async def process_vulnerabilities_creation(
+        vulnerability_ids: List,
+        images_dir: str,
+        work_dir: str,
+        template: TemplateBundle,
+        logger: logging.Logger,
+        info: ReportGenerationInfo,
+        notify: Callable
+) -> bool:
+    """
+    Processes the PDF creation of multiple vulnerabilities by compiling them into a single document and splitting the
+    resulting PDF file per vulnerability.
+
+    :return: True, if all vulnerabilities were created successfully.
+    """
+    with SessionLocal() as session:
+        vulnerabilities = [
+            await run_blocking(session.query(Vulnerability).filter_by(id=vulnerability_id).one)
+            for vulnerability_id in vulnerability_ids
+        ]
+        for vulnerability in vulnerabilities:
+            vulnerability.creation_status = ReportCreationStatus.generating
             await notify(
-                message=f"Excel report was successfully created for version: v{report_version_id} ",
-                status=ReportCreationStatus.generating,
-                query_key=query_key
+                message=f"PDF file creation started for vulnerability: {vulnerability.vulnerability_id_str}",
+                status=ReportCreationStatus.generating
             )
+        try:
+            await run_blocking(template.create_overlay, work_dir, directories=[images_dir])
+            latex_creator = await run_blocking(
+                LatexVulnerabilitiesCreator,
+                notify=notify,
+                settings=settings,
+                work_dir=work_dir,
+                images_dir=images_dir,
+                vulnerabilities=vulnerabilities,
+                info=info
+            )
+            await run_blocking(latex_creator.create)
+            # Create PDF report
+            pdf_creator = PdfReportCreator(
+                title=f"{len(vulnerabilities)} vulnerabilities",
+                notify=notify,
+                settings=settings,
+                tex_file=latex_creator.tex_file,
+                seed_key=f"vulnerabilities-{FileCache.get_key(*[str(item) for item in vulnerability_ids])}",
+                work_dir=work_dir,
+                info=info
+            )
+            await pdf_creator.create()
+            pdfs = await run_blocking(pdf_creator.split_pdf, latex_creator.PAGE_MARKER, len(vulnerabilities))
+            writer = ArtifactWriter(session=session, settings=settings)
+            for vulnerability, pdf in zip(vulnerabilities, pdfs):
+                # The Latex sources of the combined document contain all vulnerabilities of the request. We therefore
+                # create the sources of each vulnerability separately (the pandoc conversions are cached by now).
+                with tempfile.TemporaryFile() as zip_file:
+                    await create_vulnerability_sources(
+                        vulnerability=vulnerability,
+                        images_dir=images_dir,
+                        work_dir=f"{work_dir}-{vulnerability.id}",
+                        template=template,
+                        info=info,
+                        notify=notify,
+                        target=zip_file
+                    )
+                    await run_blocking(writer.write, vulnerability, "tex", zip_file)
+                vulnerability.pdf = pdf
+                vulnerability.pdf_log = None
+                vulnerability.creation_status = ReportCreationStatus.successful
+            await run_blocking(session.commit)
         except Exception as ex:
-            report_version.creation_status = ReportCreationStatus.failed
             logger.exception(ex)
+            logger.warning("Single document creation failed. Creating vulnerabilities separately.")
+            await run_blocking(session.rollback)
+            return False
+        finally:
+            await run_blocking(shutil.rmtree, work_dir, ignore_errors=True)
+        for vulnerability in vulnerabilities:
             await notify(
-                message=f"Excel report creation was unsuccessful for version: v{report_version_id}",
-                status=ReportCreationStatus.failed,
-                query_key=query_key
+                message=f"PDF file was successfully created for vulnerability: "
+                        f"{vulnerability.vulnerability_id_str}",
+                status=ReportCreationStatus.successful
             )
-        # Create Latex report
-        latex_creator = LatexReportCreator(
+    return True
+
+
+async def create_vulnerability_sources(
+        vulnerability: Vulnerability,
+        images_dir: str,
+        work_dir: str,
+        template: TemplateBundle,
+        info: ReportGenerationInfo,
+        notify: Callable,
+        target: BinaryIO
+):
+    """
+    Creates the Latex sources of a single vulnerability in the given (not yet existing) work directory and writes them
+    as ZIP file into the given target.
+    """
+    try:
+        await run_blocking(template.create_overlay, work_dir, directories=[images_dir])
+        latex_creator = await run_blocking(
+            LatexVulnerabilityCreator,
             notify=notify,
             settings=settings,
             work_dir=work_dir,
             images_dir=images_dir,
+            vulnerability=vulnerability,
             info=info
         )
+        await run_blocking(latex_creator.create)
+        await run_blocking(latex_creator.get_zip, target=target)
+    finally:
+        await run_blocking(shutil.rmtree, work_dir, ignore_errors=True)
+
+
+async def process_vulnerability_creation(
+        vulnerability_id,
+        images_dir: str,
+        work_dir: str,
+        template: TemplateBundle,
+        logger: logging.Logger,
+        info: ReportGenerationInfo,
+        notify: Callable
+):
+    """
+    Processes the PDF creation of a single vulnerability in the given (not yet existing) work directory.
+    """
+    pdf_creator = None
+    vulnerability = None
+    with SessionLocal() as session:
         try:
-            latex_creator.create()
-            report_version.tex = latex_creator.get_zip()
-            session.commit()
+            # query_key = ["vulnerability", str(vulnerability_id)]
+            vulnerability = await run_blocking(session.query(Vulnerability).filter_by(id=vulnerability_id).one)
+            vulnerability.creation_status = ReportCreationStatus.generating
             await notify(
-                message=f"Latex files were successfully created for version: v{report_version_id}",
-                status=ReportCreationStatus.generating,
-                query_key=query_key
+                message=f"PDF file creation started for vulnerability: {vulnerability.vulnerability_id_str}",
+                status=ReportCreationStatus.generating
             )
-        except Exception as ex:
-            report_version.creation_status = ReportCreationStatus.failed
-            logger.exception(ex)
+            # Create Latex report
+            await run_blocking(template.create_overlay, work_dir, directories=[images_dir])
+            # Creating the creator might lazy-load relationships of the vulnerability.
+            latex_creator = await run_blocking(
+                LatexVulnerabilityCreator,
+                notify=notify,
+                settings=settings,
+                work_dir=work_dir,
+                images_dir=images_dir,
+                vulnerability=vulnerability,
+                info=info
+            )
+            await run_blocking(latex_creator.create)
+            writer = ArtifactWriter(session=session, settings=settings)
+            with tempfile.TemporaryFile() as zip_file:
+                await run_blocking(latex_creator.get_zip, target=zip_file)
+                await run_blocking(writer.write, vulnerability, "tex", zip_file)
             await notify(
-                message=f"PDF file creation failed for version: v{report_version_id}",
-                status=ReportCreationStatus.failed,
-                query_key=query_key
+                message=f"Latex files were successfully created for vulnerability: "
+                        f"{vulnerability.vulnerability_id_str}",
+                status=ReportCreationStatus.generating,
             )
-        try:
             # Create PDF report
             pdf_creator = PdfReportCreator(
-                title=f"version: v{report_version_id}",
+                title=f"vulnerability: {vulnerability.vulnerability_id_str}",
                 notify=notify,
                 settings=settings,
                 tex_file=latex_creator.tex_file,
+                seed_key=f"vulnerability-{vulnerability_id}",
                 work_dir=work_dir,
                 info=info
             )
             await pdf_creator.create()
-            report_version.pdf = pdf_creator.get_pdf()
+            await run_blocking(writer.write, vulnerability, "pdf", pdf_creator.pdf_file)
             # We don't need the logs, if building was successful.
-            report_version.pdf_log = None # pdf_creator.get_log()
-            report_version.creation_status = ReportCreationStatus.successful
-            session.commit()
+            vulnerability.pdf_log = None # pdf_creator.get_log()
+            vulnerability.creation_status = ReportCreationStatus.successful
+            await run_blocking(session.commit)
             await notify(
-                message=f"PDF file was successfully created for version: v{report_version_id}",
+                message=f"PDF file was successfully created for vulnerability: "
+                        f"{vulnerability.vulnerability_id_str}",
                 status=ReportCreationStatus.successful,
-                query_key=query_key
+                # We cannot enable the query_key here, because this will refresh the page and potentially overwrite
+                # newly made changes.
+                # query_key=query_key
             )
         except Exception as ex:
-            report_version.creation_status = ReportCreationStatus.failed
-            try:
-                report_version.pdf_log = pdf_creator.get_log()
-                session.commit()
-            except Exception as ex1:
-                logger.exception(ex1)
+            # The vulnerability might not exist anymore.
+            if vulnerability:
+                try:
+                    vulnerability.creation_status = ReportCreationStatus.failed
+                    if pdf_creator:
+                        await run_blocking(
+                            ArtifactWriter(session=session, settings=settings).write,
+                            vulnerability,
+                            "pdf_log",
+                            pdf_creator.log_file
+                        )
+                    await run_blocking(session.commit)
+                except Exception as ex1:
+                    logger.exception(ex1)
             logger.exception(ex)
             await notify(
-                message=f"PDF file creation failed for version: v{report_version_id}",
+                message=f"PDF file creation failed for vulnerability: "
+                        f"{vulnerability.vulnerability_id_str if vulnerability else vulnerability_id}",
                 status=ReportCreationStatus.failed,
-                query_key=query_key
+                # We cannot enable the query_key here, because this will refresh the page and potentially overwrite
+                # newly made changes.
+                # query_key=query_key
             )
-    elif info.type == ReportRequestType.vulnerability:
-        for vulnerability_id in info.vulnerabilities:
-            # query_key = ["vulnerability", str(vulnerability_id)]
-            vulnerability = session.query(Vulnerability).filter_by(id=vulnerability_id).one()
-            vulnerability.creation_status = ReportCreationStatus.generating
-            await notify(
-                message=f"PDF file creation started for vulnerability: {vulnerability.vulnerability_id_str}",
-                status=ReportCreationStatus.generating
-            )
-            # Create Latex report
-            try:
-                latex_creator = LatexVulnerabilityCreator(
-                    notify=notify,
-                    settings=settings,
-                    work_dir=work_dir,
-                    images_dir=images_dir,
-                    vulnerability=vulnerability,
-                    info=info
-                )
-                latex_creator.create()
-                vulnerability.tex = latex_creator.get_zip()
-                await notify(
-                    message=f"Latex files were successfully created for vulnerability: "
-                            f"{vulnerability.vulnerability_id_str}",
-                    status=ReportCreationStatus.generating,
-                )
-                # Create PDF report
-                pdf_creator = PdfReportCreator(
-                    title=f"vulnerability: {vulnerability.vulnerability_id_str}",
-                    notify=notify,
-                    settings=settings,
-                    tex_file=latex_creator.tex_file,
-                    work_dir=work_dir,
-                    info=info
-                )
-                await pdf_creator.create()
-                vulnerability.pdf = pdf_creator.get_pdf()
-                # We don't need the logs, if building was successful.
-                vulnerability.pdf_log = None # pdf_creator.get_log()
-                vulnerability.creation_status = ReportCreationStatus.successful
-                session.commit()
-                await notify(
-                    message=f"PDF file was successfully created for vulnerability: "
-                            f"{vulnerability.vulnerability_id_str}",
-                    status=ReportCreationStatus.successful,
-                    # We cannot enable the query_key here, because this will refresh the page and potentially overwrite
-                    # newly made changes.
-                    # query_key=query_key
-                )
-            except Exception as ex:
-                vulnerability.creation_status = ReportCreationStatus.failed
-                try:
-                    vulnerability.pdf_log = pdf_creator.get_log()
-                    session.commit()
-                except Exception as ex1:
-                    logger.exception(ex1)
-                logger.exception(ex)
-                await notify(
-                    message=f"PDF file creation failed for vulnerability: {vulnerability.vulnerability_id_str}",
-                    status=ReportCreationStatus.failed,
-                    # We cannot enable the query_key here, because this will refresh the page and potentially overwrite
-                    # newly made changes.
-                    # query_key=query_key
-                )
+        finally:
+            await run_blocking(shutil.rmtree, work_dir, ignore_errors=True)
 
 
 async def process_json(data: str):
@@ -260,22 +499,24 @@ async def process_json(data: str):
                 images_dir = "images"
                 latex_dir_name = os.path.basename(settings.latex_template_directory)
                 latex_destination_dir = os.path.join(temp_dir, latex_dir_name)
-                images_fullpath = os.path.join(latex_destination_dir, images_dir)
-                shutil.copytree(
-                    settings.get_latex_template_directory(info.project.report.version),
-                    latex_destination_dir
-                )
-                if not os.path.isdir(images_fullpath):
-                    os.mkdir(images_fullpath)
-                with SessionLocal() as session:
-                    await process_report_creation(
-                        session=session,
-                        images_dir=images_dir,
-                        work_dir=latex_destination_dir,
-                        logger=logger,
-                        info=info
-                    )
-                    session.commit()
+                # The work directory only contains links to the template files, so that we do not copy the whole
+                # template for each request.
+                template = await run_blocking(get_template_bundle, settings, info.project.report.version)
+                await run_blocking(template.create_overlay, latex_destination_dir, directories=[images_dir])
+                publisher = NotificationPublisher(requestor=info.requestor, settings=settings, publish=notify_user)
+                try:
+                    with SessionLocal() as session:
+                        await process_report_creation(
+                            session=session,
+                            images_dir=images_dir,
+                            work_dir=latex_destination_dir,
+                            logger=logger,
+                            info=info,
+                            publisher=publisher
+                        )
+                        await run_blocking(session.commit)
+                finally:
+                    await publisher.close()
             except Exception as ex:
                 logger.exception(ex)
                 status = ReportCreationStatus.failed
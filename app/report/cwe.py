@@ -0,0 +1,93 @@
+# This file is part of Guardian.
+#
+# Guardian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Guardian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Guardian. If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import logging
+import threading
+from typing import Dict, Iterable
+from sqlalchemy.orm import Session
+from schema.tagging.mitre_cwe import CweBaseRelationship, CweCategory, CweWeakness
+
+__author__ = "Lukas Reiter"
+__copyright__ = "Copyright (C) 2024 Lukas Reiter"
+__license__ = "GPLv3"
+
+logger = logging.getLogger(__name__)
+
+
+class CweCategoryIndex:
+    """
+    This class maps CWE weaknesses to the name of their CWE category. As the MITRE CWE data rarely changes, the whole
+    mapping is loaded with a single query and kept in memory until it expires.
+    """
+    def __init__(self, timeout: int):
+        """
+        :param timeout: int, the number of seconds after which the mapping is reloaded. If 0, the mapping is not kept
+        in memory and only the requested weaknesses are queried.
+        """
+        self.timeout = timeout
+        self._categories = {}
+        self._loaded = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def query(session: Session, weakness_ids: Iterable | None = None) -> Dict:
+        """
+        Returns the category names of the given weaknesses (or all weaknesses, if weakness_ids is None).
+        """
+        query = (
+            session.query(CweWeakness.id, CweCategory.name)
+            .select_from(CweCategory)
+            .join(CweBaseRelationship, CweCategory.id == CweBaseRelationship.destination_id)
+            .join(CweWeakness, CweWeakness.id == CweBaseRelationship.source_id)
+        )
+        if weakness_ids is not None:
+            query = query.filter(CweWeakness.id.in_(list(weakness_ids)))
+        result = {}
+        # A weakness might belong to multiple categories, so we take the one with the lowest CWE ID.
+        for weakness_id, name in query.order_by(CweCategory.cwe_id):
+            result.setdefault(weakness_id, name)
+        return result
+
+    def get(self, session: Session, weakness_ids: Iterable) -> Dict:
+        """
+        Returns the category names of the given weaknesses.
+        """
+        weakness_ids = set(weakness_ids)
+        if not weakness_ids:
+            return {}
+        if self.timeout <= 0:
+            return self.query(session, weakness_ids)
+        with self._lock:
+            if self._loaded is None or time.monotonic() - self._loaded > self.timeout:
+                self._categories = self.query(session)
+                self._loaded = time.monotonic()
+                logger.debug(f"Loaded {len(self._categories)} CWE category mappings.")
+            return {key: value for key, value in self._categories.items() if key in weakness_ids}
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_cwe_category_index(timeout: int) -> CweCategoryIndex:
+    """
+    Returns the process-wide CWE category index.
+    """
+    global _index
+    with _index_lock:
+        if not _index:
+            _index = CweCategoryIndex(timeout=timeout)
+        return _index
@@ -15,19 +15,26 @@
 
 import os
 import re
+import pickle
 import logging
+import threading
+from io import BytesIO
 from copy import copy
 from core.config import Settings
-from typing import Callable, Dict, Tuple
-from openpyxl import load_workbook
+from typing import Any, Callable, Dict, Iterator, List, Tuple
+from openpyxl import Workbook, load_workbook
+from openpyxl.worksheet.table import TableList
+from openpyxl.worksheet.cell_range import MultiCellRange
+from openpyxl.worksheet.datavalidation import DataValidation
 from openpyxl.utils import get_column_letter, range_boundaries
 from sqlalchemy.orm import Session
 from .util import ReportCreatorBase
+from .xlsx import XlsxStreamWriter, get_column_ranges
+from .cwe import get_cwe_category_index
 from schema import SessionLocal
 from schema.project import ProjectReport
 from schema.application import Application
 from schema.reporting.report_template import ReportTemplateFileVersion
-from schema.tagging.mitre_cwe import CweBaseRelationship, CweCategory, CweWeakness
 from schema.reporting.report_section_management.vulnerability import VulnerabilityStatus
 
 __author__ = "Lukas Reiter"
@@ -37,6 +44,63 @@ __license__ = "GPLv3"
 logger = logging.getLogger(__name__)
 
 
+def _restore_table_list(items: list) -> TableList:
+    result = TableList()
+    dict.update(result, items)
+    return result
+
+
+class _WorkbookPickler(pickle.Pickler):
+    """
+    Pickler for openpyxl workbooks. TableList overrides items(), which breaks the default pickling of dictionaries.
+    """
+    def reducer_override(self, obj):
+        if isinstance(obj, TableList):
+            return _restore_table_list, (list(dict.items(obj)),)
+        return NotImplemented
+
+
+class WorkbookTemplate:
+    """
+    This class keeps a parsed Excel template file in memory. Each job obtains its own copy, which is much cheaper
+    than parsing the template file again.
+    """
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+        self.signature = self.get_signature(file_name)
+        buffer = BytesIO()
+        _WorkbookPickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(load_workbook(file_name))
+        self._content = buffer.getvalue()
+
+    @staticmethod
+    def get_signature(file_name: str) -> Tuple[int, int]:
+        stat = os.stat(file_name)
+        return stat.st_mtime_ns, stat.st_size
+
+    def clone(self) -> Workbook:
+        """
+        Returns a new copy of the template workbook.
+        """
+        return pickle.loads(self._content)
+
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_workbook(file_name: str) -> Workbook:
+    """
+    Returns a copy of the given Excel template file. The file is only parsed again, if it has changed.
+    """
+    with _templates_lock:
+        template = _templates.get(file_name)
+        if not template or template.signature != WorkbookTemplate.get_signature(file_name):
+            template = WorkbookTemplate(file_name)
+            _templates[file_name] = template
+            logger.debug(f"Loaded Excel template file '{file_name}'.")
+    return template.clone()
+
+
 class ReportCreator(ReportCreatorBase):
     """
     This class is responsible for creating the Excel report.
@@ -127,7 +191,7 @@ class ReportCreator(ReportCreatorBase):
         return application_name, component_name
 
     # Function to copy cell styles
-    def copy_cell_style(self, src_cell, tgt_cell, ws):
+    def copy_cell_style(self, src_cell, tgt_cell):
         if src_cell.has_style:
             tgt_cell.font = copy(src_cell.font)
             tgt_cell.border = copy(src_cell.border)
@@ -135,10 +199,61 @@ class ReportCreator(ReportCreatorBase):
             tgt_cell.number_format = copy(src_cell.number_format)
             tgt_cell.protection = copy(src_cell.protection)
             tgt_cell.alignment = copy(src_cell.alignment)
-        # Copy data validation
-        for dv in ws.data_validations.dataValidation:
-            if f"{src_cell.column_letter}{self.settings.excel_template_row}" in dv.cells:
-                dv.add(tgt_cell)
+
+    def get_data_validations(self, ws, from_x: int, to_x: int) -> Dict[int, List[DataValidation]]:
+        """
+        Returns the data validations of the template row per column.
+        """
+        result = {}
+        for column in range(from_x, to_x + 1):
+            cell = f"{get_column_letter(column)}{self.settings.excel_template_row}"
+            if validations := [item for item in ws.data_validations.dataValidation if cell in item.sqref]:
+                result[column] = validations
+        return result
+
+    def get_rows(self, session: Session) -> Iterator[List[Any]]:
+        """
+        Returns the values of the rows, in the order of COLUMN_NAMES.
+        """
+        vulnerabilities = [
+            vulnerability
+            for section in self.info.project.report.sections
+            for vulnerability in section.vulnerabilities
+            if vulnerability.visible and vulnerability.status not in [VulnerabilityStatus.resolved]
+        ]
+        # We resolve the CWE categories of all vulnerabilities at once.
+        cwe_categories = get_cwe_category_index(self.settings.cwe_cache_timeout).get(
+            session=session,
+            weakness_ids=[item.cwe_weakness.id for item in vulnerabilities if item.cwe_weakness]
+        )
+        for vulnerability in vulnerabilities:
+            cwe_category = ""
+            if vulnerability.cwe_weakness:
+                cwe_category = cwe_categories.get(vulnerability.cwe_weakness.id, "")
+            # We need to be consistent with the PDF creation
+            if vulnerability.cvss_score and vulnerability.cvss_score > 0 and vulnerability.cvss_vector:
+                cvss_vector = vulnerability.cvss_vector
+                cvss_score = vulnerability.cvss_score
+            else:
+                cvss_vector = ""
+                cvss_score = ""
+            yield [
+                ", ".join(
+                    [self.get_text(item.application_id) for item in self.info.project.applications]
+                ),  # Application ID
+                ", ".join(
+                    [self.get_text(item.name) for item in self.info.project.applications]
+                ),  # Application Name
+                vulnerability.vulnerability_id_str,  # D
+                self.get_text(vulnerability.name),  # Title
+                vulnerability.status_str,  # Status
+                self.get_text(vulnerability.description),  # Description
+                self.get_text(vulnerability.measure_title),  # Measure Title
+                self.get_text(vulnerability.measure_recommendation),  # Measure
+                vulnerability.severity_str,  # Severity
+                vulnerability.cvss_score,  # CVSS Score
+                self.get_text(vulnerability.cvss_vector)  # CVSS Vector
+            ]
 
     def create(self):
         """
@@ -153,54 +268,40 @@ class ReportCreator(ReportCreatorBase):
             sheet_name = self.settings.excel_sheet_name
             if not os.path.isfile(template_file):
                 raise FileNotFoundError(f"Excel template file '{template_file}' does not exist.")
-            workbook = load_workbook(template_file)
+            if self.settings.excel_engine == "stream":
+                XlsxStreamWriter(
+                    template_file=template_file,
+                    sheet_name=sheet_name,
+                    table_name=self.settings.excel_table_name,
+                    template_row=self.settings.excel_template_row
+                ).write(self.excel_file, self.get_rows(session))
+                return
+            workbook = get_workbook(template_file)
             ws = workbook[sheet_name]
             tb = ws.tables[self.settings.excel_table_name]
             from_x, from_y, to_x, to_y = range_boundaries(tb.ref)
             row = from_y + 1
+            # The data validations are extended once all rows are written.
+            data_validations = self.get_data_validations(ws, from_x, to_x)
+            styled_rows = []
             # Populate cells
-            for section in self.info.project.report.sections:
-                for vulnerability in section.vulnerabilities:
-                    if not vulnerability.visible or vulnerability.status in [VulnerabilityStatus.resolved]:
-                        continue
-                    cwe_category = ""
-                    if vulnerability.cwe_weakness:
-                        if (category := session.query(CweCategory)
-                                .join(CweBaseRelationship, CweCategory.id == CweBaseRelationship.destination_id)
-                                .join(CweWeakness, CweWeakness.id == CweBaseRelationship.source_id)
-                                .filter(CweWeakness.id == vulnerability.cwe_weakness.id)
-                                .order_by(CweCategory.cwe_id).first()):
-                            cwe_category = category.name
-                    # We need to be consistent with the PDF creation
-                    if vulnerability.cvss_score and vulnerability.cvss_score > 0 and vulnerability.cvss_vector:
-                        cvss_vector = vulnerability.cvss_vector
-                        cvss_score = vulnerability.cvss_score
-                    else:
-                        cvss_vector = ""
-                        cvss_score = ""
-                    ws[f'A{row}'] = ", ".join(
-                        [self.get_text(item.application_id) for item in self.info.project.applications]
-                    )  # Application ID
-                    ws[f'B{row}'] = ", ".join(
-                        [self.get_text(item.name) for item in self.info.project.applications]
-                    )  # Application Name
-                    ws[f'C{row}'] = vulnerability.vulnerability_id_str  # D
-                    ws[f'D{row}'] = self.get_text(vulnerability.name)  # Title
-                    ws[f'E{row}'] = vulnerability.status_str  # Status
-                    ws[f'F{row}'] = self.get_text(vulnerability.description)  # Description
-                    ws[f'G{row}'] = self.get_text(vulnerability.measure_title)  # Measure Title
-                    ws[f'H{row}'] = self.get_text(vulnerability.measure_recommendation)  # Measure
-                    ws[f'I{row}'] = vulnerability.severity_str  # Severity
-                    ws[f'J{row}'] = vulnerability.cvss_score  # CVSS Score
-                    ws[f'K{row}'] = self.get_text(vulnerability.cvss_vector)  # CVSS Vector
-                    row += 1
-                    # Apply formatting for all cells in current row
-                    if row != (from_y + 1):
-                        for x in range(0, len(self.COLUMN_NAMES)):
-                            template_cell = ws.cell(row=from_y + self.settings.excel_template_row, column=from_x + x)
-                            new_cell = ws.cell(row=row, column=from_x + x)
-                            self.copy_cell_style(template_cell, new_cell, ws)
-                    row += 1
+            for values in self.get_rows(session):
+                for x, value in enumerate(values):
+                    ws[f"{get_column_letter(1 + x)}{row}"] = value
+                row += 1
+                # Apply formatting for all cells in current row
+                if row != (from_y + 1):
+                    for x in range(0, len(self.COLUMN_NAMES)):
+                        template_cell = ws.cell(row=from_y + self.settings.excel_template_row, column=from_x + x)
+                        new_cell = ws.cell(row=row, column=from_x + x)
+                        self.copy_cell_style(template_cell, new_cell)
+                    styled_rows.append(row)
+                row += 1
+            # Copy data validation
+            for column, validations in data_validations.items():
+                ranges = get_column_ranges(column, styled_rows)
+                for validation in validations:
+                    validation.sqref = MultiCellRange([str(item) for item in validation.sqref.ranges] + ranges)
             # Update table definition
             tb.ref = f"{get_column_letter(from_x)}{from_y}:{get_column_letter(to_x)}{row - 1}"
             # Save the file
@@ -216,7 +317,7 @@ class ReportCreator(ReportCreatorBase):
             file_name = settings.get_excel_template_file(version)
             if not os.path.isfile(file_name):
                 raise FileNotFoundError(f"Excel template file '{file_name}' not found.")
-            workbook = load_workbook(file_name)
+            workbook = get_workbook(file_name)
             # Check if Sheet exist
             if settings.excel_sheet_name not in workbook.sheetnames:
                 raise ValueError(f"Sheet '{settings.excel_sheet_name}' not found in Excel template file.")
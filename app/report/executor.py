@@ -0,0 +1,47 @@
+# This file is part of Guardian.
+#
+# Guardian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Guardian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Guardian. If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import functools
+from typing import Any, Callable
+from concurrent.futures import ThreadPoolExecutor
+from core.config import settings
+
+__author__ = "Lukas Reiter"
+__copyright__ = "Copyright (C) 2024 Lukas Reiter"
+__license__ = "GPLv3"
+
+_executor = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Returns the process-wide pool that executes blocking report stages.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.blocking_workers,
+            thread_name_prefix="report-worker"
+        )
+    return _executor
+
+
+async def run_blocking(function: Callable, *args, **kwargs) -> Any:
+    """
+    Executes the given blocking function in the worker pool, so that the event loop stays responsive.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(function, *args, **kwargs))
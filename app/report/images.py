@@ -0,0 +1,168 @@
+# This file is part of Guardian.
+#
+# Guardian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Guardian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Guardian. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import hashlib
+import logging
+from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, UnidentifiedImageError
+from core.config import Settings
+from .cache import FileCache
+
+__author__ = "Lukas Reiter"
+__copyright__ = "Copyright (C) 2024 Lukas Reiter"
+__license__ = "GPLv3"
+
+logger = logging.getLogger(__name__)
+
+
+class ImagePipeline:
+    """
+    This class prepares the images of a report before they are compiled by pdflatex. Images with identical content
+    are processed only once, images wider than the maximum printed width are downscaled and photo-like images are
+    re-encoded as JPEG, which pdflatex embeds as is.
+
+    The prepared images are kept in a content-addressed store, which is shared by all jobs. Images that were already
+    prepared by a previous job are just linked into the images directory.
+    """
+    # Images with more colors are considered photo-like.
+    PHOTO_COLORS = 32768
+    # Resolution assumed by pdflatex, if an image does not specify one.
+    DEFAULT_DPI = 72
+
+    def __init__(self, settings: Settings, store: FileCache | None = None):
+        """
+        :param settings: Settings, the settings of the image preparation.
+        :param store: FileCache, the store of the prepared images.
+        """
+        self.enabled = settings.image_optimization
+        self.max_width = int(settings.image_max_width / 25.4 * settings.image_dpi)
+        self.jpeg_quality = settings.image_jpeg_quality
+        self.max_workers = settings.image_workers
+        self.store = store
+
+    @staticmethod
+    def get_hash(path: str) -> str:
+        result = hashlib.sha256()
+        with open(path, "rb") as file:
+            while chunk := file.read(1024 * 1024):
+                result.update(chunk)
+        return result.hexdigest()
+
+    def process(self, directory: str, files: List[str]) -> Dict[str, str]:
+        """
+        Prepares the given images.
+
+        :param directory: str, the directory containing the images.
+        :param files: list, the names of the images, which are prepared.
+        :return: dict, maps the name of each image to its new name (e.g., if it was re-encoded as JPEG).
+        """
+        result = {}
+        if not files or not (self.enabled or self.store):
+            return result
+        groups = {}
+        for file in files:
+            groups.setdefault(self.get_hash(os.path.join(directory, file)), []).append(file)
+        if len(groups) > 1 and self.max_workers > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_workers, len(groups))) as executor:
+                names = list(executor.map(lambda item: self.prepare(directory, item[0], item[1]), groups.items()))
+        else:
+            names = [self.prepare(directory, item[0], item[1]) for item in groups.items()]
+        for (first, *duplicates), name in zip(groups.values(), names):
+            result[first] = name
+            for duplicate in duplicates:
+                # Duplicates are replaced by links to the already prepared image.
+                result[duplicate] = f"{os.path.splitext(duplicate)[0]}{os.path.splitext(name)[1]}"
+                os.remove(os.path.join(directory, duplicate))
+                try:
+                    os.link(os.path.join(directory, name), os.path.join(directory, result[duplicate]))
+                except OSError:
+                    shutil.copyfile(os.path.join(directory, name), os.path.join(directory, result[duplicate]))
+        return result
+
+    def prepare(self, directory: str, digest: str, files: List[str]) -> str:
+        """
+        Prepares the first of the given images, which all have the given content hash. If the image is already in
+        the store, it is linked into the directory instead.
+
+        :return: str, the name of the prepared image.
+        """
+        file = files[0]
+        path = os.path.join(directory, file)
+        key = FileCache.get_key("image", digest, str(self.enabled), str(self.max_width), str(self.jpeg_quality))
+        extension_key = FileCache.get_key(key, "extension")
+        if self.store and (extension := self.store.get(extension_key)) is not None:
+            name = f"{os.path.splitext(file)[0]}{extension.decode('utf-8')}"
+            # We link to a temporary file first, so that the original image is kept, if the entry was evicted.
+            temp_file = os.path.join(directory, f".{digest}")
+            if self.store.link(key, temp_file):
+                os.replace(temp_file, os.path.join(directory, name))
+                if name != file:
+                    os.remove(path)
+                return name
+        name = self.optimize(directory, file) if self.enabled else file
+        if self.store:
+            self.store.put_file(key, os.path.join(directory, name))
+            self.store.put(extension_key, os.path.splitext(name)[1].encode("utf-8"), replace=True)
+        return name
+
+    def optimize(self, directory: str, file: str) -> str:
+        """
+        Downscales and re-encodes the given image, if necessary.
+
+        :return: str, the name of the prepared image.
+        """
+        path = os.path.join(directory, file)
+        try:
+            with Image.open(path) as image:
+                if image.format not in ["PNG", "JPEG"] or getattr(image, "is_animated", False):
+                    return file
+                image.load()
+                original_format = image.format
+                dpi = image.info.get("dpi", (self.DEFAULT_DPI, self.DEFAULT_DPI))
+                resize = image.width > self.max_width
+                if image.mode == "RGBA" and image.getextrema()[3] == (255, 255):
+                    image = image.convert("RGB")
+                photo = original_format == "PNG" and image.mode in ["RGB", "L"] and \
+                    image.getcolors(self.PHOTO_COLORS) is None
+                if not resize and not photo:
+                    return file
+                if resize:
+                    # We adjust the resolution, so that the printed size of the image does not change.
+                    factor = self.max_width / image.width
+                    image = image.resize(
+                        (self.max_width, max(round(image.height * factor), 1)),
+                        Image.Resampling.LANCZOS
+                    )
+                    dpi = (dpi[0] * factor, dpi[1] * factor)
+                if photo or original_format == "JPEG":
+                    name = f"{os.path.splitext(file)[0]}.jpg"
+                    image.convert("RGB").save(
+                        os.path.join(directory, name),
+                        "JPEG",
+                        quality=self.jpeg_quality,
+                        dpi=dpi
+                    )
+                else:
+                    name = file
+                    image.save(path, "PNG", dpi=dpi)
+        except (OSError, UnidentifiedImageError, ValueError) as ex:
+            logger.warning(f"Could not prepare image '{file}': {ex}")
+            return file
+        if name != file:
+            os.remove(path)
+        return name
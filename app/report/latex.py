@@ -18,12 +18,16 @@ import os
 import re
 import enum
 import logging
-import pypandoc
 from io import BytesIO
+from functools import cache
 from urllib.parse import urlparse
 from enum import Enum, IntEnum
 from core.config import Settings
 from .util import ReportCreatorBase
+from .cache import FileCache, get_cache
+from .images import ImagePipeline
+from .pandoc import PandocConverter
+from .template import detach_file
 from schema import ReportGenerationInfo, SessionLocal
 from schema.user import UserReport, User
 from schema.util import SeverityType
@@ -33,7 +37,7 @@ from schema.reporting.report_section_management.vulnerability import (
     VulnerabilityReport, Vulnerability, VulnerabilityStatus
 )
 from PIL import Image, ImageOps, ImageDraw
-from typing import Callable, Dict, List
+from typing import BinaryIO, Callable, Dict, List, Set
 
 __author__ = "Lukas Reiter"
 __copyright__ = "Copyright (C) 2024 Lukas Reiter"
@@ -43,6 +47,11 @@ DEFAULT_AVATAR = "iVBORw0KGgoAAAANSUhEUgAAAfYAAAH2CAYAAACC6668AAAMPWlDQ1BJQ0MgUH
 logger = logging.getLogger(__name__)
 
 
+@cache
+def get_default_avatar() -> bytes:
+    return base64.b64decode(DEFAULT_AVATAR)
+
+
 class FileName(Enum):
     report = "report.tex"
     package = "guardian.sty"
@@ -98,6 +107,35 @@ class ReportCreator(ReportCreatorBase):
             result = [(section.name, section.severity_distribution_dict[severity]) for section in self.report_sections]
             self._severity_section_distribution[color.name] = result
         self._re_latex_commands = re.compile(r"\\(\w+)[\s\*]*(\[.*?\])?\s*\{.*?\}", re.IGNORECASE)
+        self._re_command_references = re.compile(r"\\([a-zA-Z]+)")
+        # All Markdown fragments are collected and converted at once, when the Latex files are written.
+        self.converter = PandocConverter(
+            extra_args=self.settings.pandoc_arguments,
+            batch=self.settings.pandoc_batch_conversion,
+            cache=get_cache(
+                directory=self.settings.get_cache_directory("pandoc"),
+                max_size=self.settings.pandoc_cache_size,
+                max_memory_size=self.settings.pandoc_cache_memory_size
+            ),
+            max_processes=self.settings.pandoc_processes
+        )
+        self._files = []
+        # Relative paths of the files written by this creator
+        self.generated_files = set()
+        self.avatar_cache = get_cache(
+            directory=self.settings.get_cache_directory("avatars"),
+            max_size=self.settings.avatar_cache_size,
+            max_memory_size=self.settings.avatar_cache_memory_size
+        )
+        self.image_pipeline = ImagePipeline(
+            self.settings,
+            store=get_cache(
+                directory=self.settings.get_cache_directory("images"),
+                max_size=self.settings.image_store_size
+            ) if self.settings.image_store_size > 0 else None
+        )
+        # Maps the names of the saved images to the names of the prepared images
+        self.image_files = {}
 
     @property
     def tex_file(self):
@@ -112,7 +150,12 @@ class ReportCreator(ReportCreatorBase):
         """
         if not user:
             return
-        avatar = user.avatar if user.avatar else base64.b64decode(DEFAULT_AVATAR)
+        avatar = user.avatar if user.avatar else get_default_avatar()
+        file_name = os.path.join(self.images_full_path, f"{user.id}.png")
+        # The same users appear on many reports, so we reuse their thumbnails.
+        key = FileCache.get_key("avatar", "300", avatar)
+        if self.avatar_cache.link(key, file_name):
+            return
         # Create a BytesIO object from the byte stream
         byte_io = BytesIO(avatar)
         # Open image file
@@ -126,7 +169,12 @@ class ReportCreator(ReportCreatorBase):
         # Apply mask to image
         img.putalpha(mask)
         # Save circular thumbnail image
-        img.save(os.path.join(self.images_full_path, f"{user.id}.png"))
+        result = BytesIO()
+        img.save(result, format="PNG")
+        self.avatar_cache.put(key, result.getvalue())
+        if not self.avatar_cache.link(key, file_name):
+            with open(file_name, "wb") as file:
+                file.write(result.getvalue())
 
     def convert_markdown_images(self, report_text):
         """
@@ -138,7 +186,8 @@ class ReportCreator(ReportCreatorBase):
         def image_replacement(match):
             caption = match.group("caption")
             url = urlparse(match.group("path"))
-            file_path = os.path.join(self.images_dir, f"{os.path.basename(url.path)}.png")
+            file_name = f"{os.path.basename(url.path)}.png"
+            file_path = os.path.join(self.images_dir, self.image_files.get(file_name, file_name))
             try:
                 if url.query:
                     parameters = [tuple(item.split("=")) for item in url.query.split("&")]
@@ -323,8 +372,7 @@ class ReportCreator(ReportCreatorBase):
         else:
             title_prefix = ""
         # Save files
-        for file in vulnerability.files:
-            file.save_to_file(self.images_full_path)
+        self.save_images(vulnerability.files)
         # Create vulnerability report
         vulnerability_name = self.get_tex(
             f"{title_prefix}{vulnerability.name}",
@@ -447,23 +495,58 @@ class ReportCreator(ReportCreatorBase):
                 result += self.get_vulnerability(vulnerability)
         return os.linesep.join(result)
 
-    def write_file(self, file: FileName | None, content: str, mode: str = "w") -> str:
+    def write_file(
+            self,
+            file: FileName | None,
+            content: str | Callable[[List[str]], str],
+            mode: str = "w"
+    ) -> str | Callable[[List[str]], str]:
         """
-        This method writes the content to the given file.
+        This method registers the content for the given file. The file is written by flush_files, once all Markdown
+        fragments have been converted. If the content is a function, it is called with the contents of all other
+        files, once they are converted.
         """
-        file_name = os.path.join(self.work_dir, str(file.value))
         if not file:
             return content
-        with open(file_name, mode) as f:
-            f.write(content)
+        self._files.append((file, content, mode))
+        self.generated_files.add(str(file.value))
         return content
 
+    def flush_files(self):
+        """
+        This method converts all pending Markdown fragments and writes the registered files.
+        """
+        self.converter.flush()
+        contents = [self.converter.resolve(content) if isinstance(content, str) else content for _, content, _ in
+                    self._files]
+        # Deferred contents (see _get_package) are created from the contents of all other files.
+        resolved = [item for item in contents if isinstance(item, str)]
+        contents = [item if isinstance(item, str) else item(resolved) for item in contents]
+        for (file, _, mode), content in zip(self._files, contents):
+            file_name = os.path.join(self.work_dir, str(file.value))
+            # Template files are shared with other jobs, so we must not modify them in place.
+            detach_file(file_name, keep_content="a" in mode)
+            with open(file_name, mode) as f:
+                f.write(content)
+        self._files = []
+
     def save_images(self, images: List[FileReport]):
         """
-        Saves the images to the images directory.
+        Saves the images to the images directory and prepares them for pdflatex.
         """
+        directory = os.path.join(self.work_dir, self.images_full_path)
+        existing = set(os.listdir(directory))
         for image in images:
-            image.save_to_file(os.path.join(self.work_dir, self.images_full_path))
+            image.save_to_file(directory)
+        self.image_files.update(
+            self.image_pipeline.process(directory, [item for item in os.listdir(directory) if item not in existing])
+        )
+
+    def sanitize_placeholder(self, value: str) -> str:
+        """
+        Checks the value of a placeholder for invalid LaTeX commands.
+        """
+        return self.test_latex_injection(value)
 
     def test_latex_injection(self, markdown: str) -> str:
         """
@@ -489,7 +572,8 @@ class ReportCreator(ReportCreatorBase):
             has_images: bool = False
     ) -> str:
         """
-        This method converts the given Markdown text to Latex.
+        This method converts the given Markdown text to Latex. The returned value is a token, which is replaced by the
+        Latex code when the files are written (see flush_files).
 
         :param markdown: str, the Markdown text to convert.
         :param pre_placeholder_fn: function, a function that processes placeholders before the conversion.
@@ -506,26 +590,20 @@ class ReportCreator(ReportCreatorBase):
             placeholder_pattern=self.pre_placeholder_pattern,
             placeholder_fn=pre_placeholder_fn
         ) if pre_placeholder_fn else result
-        # We need to convert the Markdown to Latex.
-        result = pypandoc.convert_text(
-            source=result,
-            to="tex",
-            format="markdown",
-            extra_args=self.settings.pandoc_arguments,
-            encoding="utf-8",
-            verify_format=True,
-            sandbox=True,
-            # cworkdir=self.work_dir
-        ).strip()
-        # We perform post-processing on the placeholders.
-        result = self.replace_placeholders(
-            report_text=result,
-            placeholder_values=self.placeholders,
-            placeholder_pattern=self.post_placeholder_pattern,
-            placeholder_fn=post_placeholder_fn
-        ) if post_placeholder_fn else result
-        # We perform final post-processing (e.g., replace \href by \slink or 1 by 1^{st}).
-        return self.post_processing_func(result)
+
+        def finish(tex: str) -> str:
+            # We perform post-processing on the placeholders.
+            tex = self.replace_placeholders(
+                report_text=tex,
+                placeholder_values=self.placeholders,
+                placeholder_pattern=self.post_placeholder_pattern,
+                placeholder_fn=post_placeholder_fn
+            ) if post_placeholder_fn else tex
+            # We perform final post-processing (e.g., replace \href by \slink or 1 by 1^{st}).
+            return self.post_processing_func(tex)
+        # We need to convert the Markdown to Latex. The conversion is deferred until flush_files is called and we
+        # therefore return a token, which is replaced by the final Latex code.
+        return self.converter.convert(result, finish=finish)
 
     def _get_report(self) -> str:
         """
@@ -557,11 +635,31 @@ class ReportCreator(ReportCreatorBase):
         This method creates/returns the variables file.
         """
         command = lambda command, value: f"\\newcommand{{\\{command}}}{{{value}}}{os.linesep}"
-        result = ""
-        for key, value in self.placeholders.items():
-            if isinstance(value, str):
-                result += command(key.replace("_", ""), value)
-        return self.write_file(FileName.package, result, mode="a")
+
+        def get_package(contents: List[str]) -> str:
+            names = self.placeholders.keys()
+            if self.settings.latex_package_referenced_only:
+                # Only the placeholders used by the template or the generated files are evaluated and defined.
+                references = self.get_command_references(contents)
+                names = [key for key in names if key.replace("_", "") in references]
+            return "".join(command(key.replace("_", ""), self.placeholders[key]) for key in names)
+        # The variables are only known, once all other files are converted (see flush_files).
+        return self.write_file(FileName.package, get_package, mode="a")
+
+    def get_command_references(self, contents: List[str]) -> Set[str]:
+        """
+        Returns the names of all Latex commands used by the given contents or the Latex files of the work directory.
+        """
+        result = set()
+        for content in contents:
+            result.update(self._re_command_references.findall(content))
+        for root, directories, files in os.walk(self.work_dir):
+            directories[:] = [item for item in directories if os.path.join(root, item) != self.images_full_path]
+            for file in files:
+                if os.path.splitext(file)[1].lower() in [".tex", ".sty", ".cls"]:
+                    with open(os.path.join(root, file), "r", errors="ignore") as f:
+                        result.update(self._re_command_references.findall(f.read()))
+        return result
 
     def _get_report_history(self) -> str:
         """
@@ -755,21 +853,21 @@ class ReportCreator(ReportCreatorBase):
         """
         self._preparation()
         self._create()
+        self.flush_files()
 
     def _preparation(self):
         """
         Checks the prerequisites for creating the Latex files.
         """
-        # Check placeholders for invalid LaTeX commands
-        for key, value in self.placeholders.items():
-            self._placeholders[key] = self.test_latex_injection(value)
         # Save images
         self.save_images(self.project.report.files)
         self.save_images(self.project.report.report_template.files)
 
     def _create(self):
         """
-        Creates the Latex sources based on the given data.
+        Creates the Latex sources based on the given data. The methods below only register their Markdown fragments
+        and files. The fragments of all files are converted together (and concurrently) by flush_files, which then
+        writes the files in the order they were registered here.
         """
         # Create the report package
         self._get_package()
@@ -788,12 +886,23 @@ class ReportCreator(ReportCreatorBase):
         # Create the report postfix Latex file.
         self._get_report_postfix()
 
-    def get_zip(self) -> bytes:
+    def get_zip(self, target: BinaryIO | None = None) -> bytes | None:
         """
         Returns the created file structure as a ZIP file.
+        :param target: file object, if given, the ZIP file is written into it instead of being returned.
         :return:
         """
-        return self.create_zip(self.work_dir)
+        files = None
+        if not self.settings.latex_zip_include_template:
+            files = list(self.generated_files)
+            for root, _, names in os.walk(self.images_full_path):
+                files += [os.path.relpath(os.path.join(root, name), self.work_dir) for name in names]
+        return self.create_zip(
+            self.work_dir,
+            files=files,
+            compression_level=self.settings.latex_zip_compression_level,
+            target=target
+        )
 
     @staticmethod
     def check(settings: Settings):
@@ -840,3 +949,66 @@ class VulnerabilityCreator(ReportCreator):
         self._get_package()
         # Create the report Latex file that is imported by the main Latex file.
         self._get_report()
+
+
+class VulnerabilitiesCreator(ReportCreator):
+    """
+    This class is responsible for creating the Latex source code of multiple vulnerabilities in a single document. The
+    start page of each vulnerability is written to the aux file, so that the PDF can be split afterward (see
+    PdfReportCreator.split_pdf).
+
+    Each vulnerability is numbered as if it was a document on its own. The page number restarts at each vulnerability
+    and the LastPage label used by the footer refers to the vulnerability's last page.
+    """
+    PAGE_MARKER = "guardianvulnerability"
+    # Counts the pages shipped out, so that the recorded start pages are the page indices within the PDF file.
+    PAGE_COUNTER = "guardianpdfpage"
+
+    def __init__(
+            self,
+            vulnerabilities: List[Vulnerability],
+            **kwargs
+    ):
+        super().__init__(**kwargs)
+        self.vulnerabilities = [VulnerabilityReport.from_orm(item) for item in vulnerabilities]
+
+    def _get_report(self) -> str:
+        """
+        This method creates the report.
+        """
+        # We keep the original LastPage label, so that it can be restored at the end. Otherwise, LaTeX would report a
+        # changed label and request another pass.
+        result = [
+            f"\\newcounter{{{self.PAGE_COUNTER}}}",
+            f"\\setcounter{{{self.PAGE_COUNTER}}}{{\\ReadonlyShipoutCounter}}",
+            f"\\AddToHook{{shipout/before}}{{\\stepcounter{{{self.PAGE_COUNTER}}}}}",
+            "\\global\\expandafter\\let\\expandafter\\guardianlastpage\\csname r@LastPage\\endcsname",
+        ]
+        for i, vulnerability in enumerate(self.vulnerabilities):
+            label = f"{self.PAGE_MARKER}:{i}:last"
+            result.append("\\setcounter{page}{1}")
+            result.append(
+                f"\\global\\expandafter\\let\\csname r@LastPage\\expandafter\\endcsname\\csname r@{label}\\endcsname"
+            )
+            # Each vulnerability starts on a new page. At shipout, we record this page in the aux file using a command
+            # that LaTeX ignores when reading the aux file.
+            result.append(
+                f"\\expandafter\\write\\csname @auxout\\endcsname"
+                f"{{\\string\\@gobbletwo{{{self.PAGE_MARKER}:{i}}}{{\\number\\value{{{self.PAGE_COUNTER}}}}}}}"
+            )
+            content = self.get_vulnerability(vulnerability)
+            # The label is placed on the last page of the vulnerability (i.e., before the final page break).
+            content.insert(len(content) - 1, f"\\label{{{label}}}")
+            result += content
+        result.append("\\global\\expandafter\\let\\csname r@LastPage\\endcsname\\guardianlastpage")
+        result = os.linesep.join(result)
+        return self.write_file(FileName.report, result)
+
+    def _create(self):
+        """
+        Creates the Latex sources based on the given data.
+        """
+        # Create the report package
+        self._get_package()
+        # Create the report Latex file that is imported by the main Latex file.
+        self._get_report()
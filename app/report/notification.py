@@ -0,0 +1,177 @@
+# This file is part of Guardian.
+#
+# Guardian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Guardian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Guardian. If not, see <https://www.gnu.org/licenses/>.
+
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+from typing import Any, Awaitable, Callable, Dict, List
+from core.config import Settings
+from schema import ReportRequestor
+from schema.reporting import ReportCreationStatus
+
+__author__ = "Lukas Reiter"
+__copyright__ = "Copyright (C) 2024 Lukas Reiter"
+__license__ = "GPLv3"
+
+logger = logging.getLogger(__name__)
+
+
+class NotificationRateLimiter:
+    """
+    This class tracks when each requestor was notified the last time, so that all jobs of a requestor together do not
+    exceed the configured rate.
+    """
+    def __init__(self, rate: float):
+        """
+        :param rate: float, the maximum number of notifications per second and requestor (0 disables the limit).
+        """
+        self.interval = 1 / rate if rate > 0 else 0
+        self._notified: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def get_delay(self, key: str) -> float:
+        """
+        Returns the number of seconds until the given requestor can be notified again.
+        """
+        with self._lock:
+            return max(self._notified.get(key, 0) + self.interval - time.monotonic(), 0)
+
+    def record(self, key: str):
+        """
+        Records that the given requestor was notified.
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._notified[key] = now
+            if len(self._notified) > 1024:
+                # We forget requestors, which are not limited anymore.
+                self._notified = {
+                    key: value for key, value in self._notified.items() if value + self.interval > now
+                }
+
+
+class NotificationPublisher:
+    """
+    This class buffers the notifications of a report creation job and publishes them in a background task, so that
+    the job does not wait for Redis.
+
+    Intermediate (generating) notifications with the same query key are coalesced, so only the latest one is
+    published, and they are rate-limited per requestor. Terminal (successful/failed) notifications supersede pending
+    intermediate ones and are published immediately.
+    """
+    TERMINAL_STATES = [ReportCreationStatus.successful, ReportCreationStatus.failed]
+
+    def __init__(
+            self,
+            requestor: ReportRequestor,
+            settings: Settings,
+            publish: Callable[..., Awaitable[None]]
+    ):
+        """
+        :param requestor: ReportRequestor, the user who is notified.
+        :param settings: Settings, the settings of the notifications.
+        :param publish: function, publishes a single notification (see notify_user).
+        """
+        self.requestor = requestor
+        self.enabled = settings.notification_buffering
+        self.publish = publish
+        self.limiter = get_rate_limiter(settings.notification_rate)
+        self.key = str(requestor.id)
+        # Notifications, which are published in order without delay
+        self._queue = deque()
+        # Latest intermediate notification per query key
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._event = asyncio.Event()
+        self._closed = False
+        self._task = None
+
+    async def notify(self, message, status: ReportCreationStatus, query_key: List[Any] | None = None):
+        """
+        Buffers the given notification.
+        """
+        notification = dict(message=message, status=status, query_key=query_key)
+        if not self.enabled or self._closed:
+            await self._publish(notification)
+            return
+        key = str(query_key)
+        if status in self.TERMINAL_STATES:
+            # Pending notifications for other queries are published first to keep their order.
+            self._pending.pop(key, None)
+            self._queue.extend(self._pending.values())
+            self._pending = {}
+            self._queue.append(notification)
+        else:
+            self._pending.pop(key, None)
+            self._pending[key] = notification
+        if not self._task:
+            self._task = asyncio.create_task(self._run())
+        self._event.set()
+
+    async def close(self):
+        """
+        Publishes all buffered notifications (without rate limit) and stops the background task.
+        """
+        self._closed = True
+        self._event.set()
+        if self._task:
+            await self._task
+            self._task = None
+
+    async def _run(self):
+        while self._queue or self._pending or not self._closed:
+            if self._queue:
+                await self._publish_buffered(self._queue.popleft())
+                continue
+            timeout = None
+            if self._pending:
+                timeout = self.limiter.get_delay(self.key)
+                if timeout <= 0 or self._closed:
+                    await self._publish_buffered(self._pending.pop(next(iter(self._pending))))
+                    continue
+            # The event is set by notify and close, so we wake up as soon as a terminal notification arrives.
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _publish(self, notification: Dict[str, Any]):
+        self.limiter.record(self.key)
+        await self.publish(requestor=self.requestor, **notification)
+
+    async def _publish_buffered(self, notification: Dict[str, Any]):
+        """
+        Publishes a buffered notification. Errors are only logged, so that the background task keeps running.
+        """
+        try:
+            await self._publish(notification)
+        except Exception as ex:
+            logger.exception(ex)
+
+
+_limiters = {}
+_limiter_lock = threading.Lock()
+
+
+def get_rate_limiter(rate: float) -> NotificationRateLimiter:
+    """
+    Returns the process-wide rate limiter of the given rate.
+    """
+    with _limiter_lock:
+        if rate not in _limiters:
+            _limiters[rate] = NotificationRateLimiter(rate=rate)
+        return _limiters[rate]
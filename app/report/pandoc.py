@@ -0,0 +1,249 @@
+# This file is part of Guardian.
+#
+# Guardian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Guardian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Guardian. If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import uuid
+import logging
+import pypandoc
+from functools import cache
+from typing import Callable, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from .cache import FileCache
+
+__author__ = "Lukas Reiter"
+__copyright__ = "Copyright (C) 2024 Lukas Reiter"
+__license__ = "GPLv3"
+
+logger = logging.getLogger(__name__)
+
+
+class PandocConversionException(Exception):
+    def __init__(self, message):
+        super().__init__(message)
+
+
+@cache
+def get_pandoc_version() -> str:
+    """
+    Returns the version of the installed pandoc binary.
+    """
+    return pypandoc.get_pandoc_version()
+
+
+class Fragment:
+    """
+    A Markdown fragment whose LaTeX conversion is deferred until the converter is flushed.
+    """
+    def __init__(self, token: str, source: str, finish: Callable[[str], str] | None = None):
+        self.token = token
+        self.source = source
+        self.finish = finish
+        self.result = None
+
+    @property
+    def resolved(self) -> bool:
+        return self.result is not None
+
+
+class PandocConverter:
+    """
+    This class collects all Markdown fragments of a job and converts them to LaTeX with as few pandoc runs as
+    possible.
+
+    Calling convert returns a unique token, which can be embedded into other fragments or file contents. Once flush is
+    called, all pending fragments are converted in a single pandoc run per nesting level and resolve replaces the
+    tokens by the final LaTeX code.
+    """
+    # Markdown constructs that carry document-wide state (header identifiers, reference links, footnotes, example
+    # lists or LaTeX macros). Fragments containing them are converted on their own, so that they cannot influence
+    # each other in a combined pandoc run.
+    STATEFUL_PATTERN = re.compile(
+        r"(^\s{0,3}#{1,6}(\s|$))|"
+        r"(^\s{0,3}(=+|-+)\s*$)|"
+        r"(^\s{0,3}\[[^\]]+\]:)|"
+        r"(\(@[\w\-]*\))|"
+        r"(\\(re)?newcommand|\\def\b|\\let\b)",
+        re.MULTILINE
+    )
+    STANDALONE_ARGUMENTS = ["-s", "--standalone", "--template", "--toc", "--table-of-contents"]
+
+    def __init__(
+            self,
+            extra_args: List[str],
+            batch: bool = True,
+            cache: FileCache | None = None,
+            max_processes: int = 1
+    ):
+        """
+        :param extra_args: list, additional pandoc arguments.
+        :param batch: bool, whether fragments may be combined into a single pandoc run.
+        :param cache: FileCache, the cache for converted fragments.
+        :param max_processes: int, the maximum number of pandoc processes running concurrently.
+        """
+        self.extra_args = list(extra_args)
+        self.cache = cache
+        self.max_processes = max(max_processes, 1)
+        self.batch = batch and not any(
+            item.split("=")[0] in self.STANDALONE_ARGUMENTS for item in self.extra_args
+        )
+        nonce = uuid.uuid4().hex
+        self._token_prefix = f"guardianfragment{nonce}"
+        self._separator_prefix = f"guardianseparator{nonce}"
+        self._token_pattern = re.compile(rf"{self._token_prefix}x(\d+)y")
+        self._separator_pattern = re.compile(rf"^{self._separator_prefix}x(\d+)y$", re.MULTILINE)
+        self._fragments: Dict[str, Fragment] = {}
+        self._pending: List[Fragment] = []
+
+    def convert(self, markdown: str, finish: Callable[[str], str] | None = None) -> str:
+        """
+        Registers the given Markdown for conversion and returns the token representing its final LaTeX code.
+
+        :param markdown: str, the pre-processed Markdown text, which may contain tokens of other fragments.
+        :param finish: function, post-processes the LaTeX code returned by pandoc.
+        """
+        token = f"{self._token_prefix}x{len(self._fragments)}y"
+        fragment = Fragment(token=token, source=markdown, finish=finish)
+        self._fragments[token] = fragment
+        self._pending.append(fragment)
+        return token
+
+    def resolve(self, text: str) -> str:
+        """
+        Replaces all tokens in the given text by the converted LaTeX code.
+        """
+        def replacement(match: re.Match) -> str:
+            fragment = self._fragments.get(match.group(0))
+            if not fragment:
+                raise PandocConversionException(f"Unknown fragment token '{match.group(0)}'.")
+            if not fragment.resolved:
+                raise PandocConversionException(f"Fragment '{match.group(0)}' has not been converted yet.")
+            return self.resolve(fragment.result)
+        return self._token_pattern.sub(replacement, text)
+
+    def flush(self):
+        """
+        Converts all pending fragments. Fragments that embed other fragments are converted after them.
+        """
+        while self._pending:
+            ready = []
+            waiting = []
+            for fragment in self._pending:
+                unresolved = [
+                    token for token in self._token_pattern.findall(fragment.source)
+                    if not self._fragments[f"{self._token_prefix}x{token}y"].resolved
+                ]
+                if unresolved:
+                    waiting.append(fragment)
+                else:
+                    fragment.source = self.resolve(fragment.source)
+                    ready.append(fragment)
+            if not ready:
+                raise PandocConversionException("Fragments contain circular references.")
+            self._pending = waiting
+            results = self.convert_many([fragment.source for fragment in ready])
+            for fragment, result in zip(ready, results):
+                # The finish function might register new fragments, which are picked up by the next iteration.
+                fragment.result = fragment.finish(result) if fragment.finish else result
+
+    def convert_many(self, sources: List[str]) -> List[str]:
+        """
+        Converts the given Markdown texts to LaTeX and returns the results in the same order.
+        """
+        results = [None] * len(sources)
+        keys = [None] * len(sources)
+        jobs = []
+        batch = []
+        for i, source in enumerate(sources):
+            if not source.strip():
+                results[i] = ""
+                continue
+            if self.cache:
+                keys[i] = self.get_cache_key(source)
+                if (cached := self.cache.get(keys[i])) is not None:
+                    results[i] = cached.decode("utf-8")
+                    continue
+            if not self.batch or self.STATEFUL_PATTERN.search(source):
+                jobs.append([i])
+            else:
+                batch.append(i)
+        if len(batch) == 1:
+            jobs.append(batch)
+        elif batch:
+            logger.debug(f"Converting {len(batch)} Markdown fragments in a single pandoc run.")
+            jobs.append(batch)
+        # The pandoc runs are independent of each other. We therefore run them concurrently, so that long fragments
+        # (e.g., prefix and postfix sections) do not wait for each other.
+        if len(jobs) > 1 and self.max_processes > 1:
+            with ThreadPoolExecutor(max_workers=min(self.max_processes, len(jobs))) as executor:
+                outputs = list(executor.map(lambda job: self._run_job([sources[i] for i in job]), jobs))
+        else:
+            outputs = [self._run_job([sources[i] for i in job]) for job in jobs]
+        for job, output in zip(jobs, outputs):
+            for i, result in zip(job, output):
+                results[i] = result
+        if self.cache:
+            for key, result in zip(keys, results):
+                if key:
+                    self.cache.put(key, result.encode("utf-8"))
+        return results
+
+    def get_cache_key(self, source: str) -> str:
+        """
+        Returns the cache key of the given pre-processed Markdown text.
+        """
+        return FileCache.get_key(get_pandoc_version(), *self.extra_args, "markdown", "tex", source)
+
+    def _run_job(self, sources: List[str]) -> List[str]:
+        """
+        Converts the given fragments with a single pandoc run.
+        """
+        return [self._convert(sources[0])] if len(sources) == 1 else self._convert_batch(sources)
+
+    def _convert_batch(self, sources: List[str]) -> List[str]:
+        """
+        Converts the given fragments in one pandoc run by separating them with unique marker paragraphs.
+        """
+        separators = [f"{self._separator_prefix}x{i}y" for i in range(len(sources) - 1)]
+        document = sources[0]
+        for separator, source in zip(separators, sources[1:]):
+            document += f"\n\n{separator}\n\n{source}"
+        output = self._run_pandoc(document)
+        matches = self._separator_pattern.findall(output)
+        if matches != [str(i) for i in range(len(separators))]:
+            # A fragment swallowed a separator (e.g., an unterminated code block), so we cannot reliably map the
+            # results back. We therefore fall back to converting the fragments one by one.
+            logger.warning("Combined pandoc conversion could not be split. Converting fragments individually.")
+            return [self._convert(source) for source in sources]
+        return [item.strip() for item in self._separator_pattern.split(output)[::2]]
+
+    def _convert(self, source: str) -> str:
+        """
+        Converts a single fragment.
+        """
+        return self._run_pandoc(source).strip()
+
+    def _run_pandoc(self, source: str) -> str:
+        """
+        Runs pandoc to convert the given Markdown to LaTeX.
+        """
+        return pypandoc.convert_text(
+            source=source,
+            to="tex",
+            format="markdown",
+            extra_args=self.extra_args,
+            encoding="utf-8",
+            verify_format=True,
+            sandbox=True
+        )
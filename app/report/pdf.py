@@ -14,17 +14,33 @@
 # along with Guardian. If not, see <https://www.gnu.org/licenses/>.
 
 import os
+import re
+import shutil
 import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
 import subprocess
-from typing import Tuple, Any
+from io import BytesIO
+from typing import Dict, List, Tuple, Any
+from pypdf import PdfReader, PdfWriter
 from core.config import Settings
 from schema.reporting import ReportCreationStatus
+from schema.reporting.report_template import ReportTemplateFileVersion
 from .util import ReportCreatorBase
+from .cache import FileCache, get_cache
+from .executor import run_blocking
 
 __author__ = "Lukas Reiter"
 __copyright__ = "Copyright (C) 2024 Lukas Reiter"
 __license__ = "GPLv3"
 
+logger = logging.getLogger(__name__)
+
+# Serializes the creation of format files within the process.
+_format_lock = threading.Lock()
+
 
 class PdfLatexCompilationException(Exception):
     def __init__(self, message):
@@ -35,12 +51,23 @@ class ReportCreator(ReportCreatorBase):
     """
     This class is responsible for creating PDFs.
     """
+    # Auxiliary files, which pdflatex reads in the next pass. The document has converged, once they do not change
+    # anymore.
+    AUXILIARY_EXTENSIONS = [".aux", ".toc", ".out", ".lof", ".lot"]
+
     def __init__(
             self,
             tex_file: str,
             title: Any,
+            seed_key: str | None = None,
             **kwargs
     ):
+        """
+        :param tex_file: str, the main Latex file.
+        :param title: Any, the title used in the user notifications.
+        :param seed_key: str, the key under which the auxiliary files are persisted. The auxiliary files of the
+        previous build are used as starting point, so that a rebuild often converges in a single pass.
+        """
         super().__init__(**kwargs)
         self.title = str(title)
         self.pdflatex = self.settings.pdflatex_file
@@ -53,13 +80,32 @@ class ReportCreator(ReportCreatorBase):
         self.pdf_file = os.path.join(path, f"{os.path.splitext(file)[0]}.pdf")
         self.stdout = ""
         self.stderr = ""
+        self.passes = 0
+        self.format_file = None
+        self.seed_key = seed_key
+        self.seed_cache = get_cache(
+            directory=self.settings.get_cache_directory("auxiliary"),
+            max_size=self.settings.pdflatex_seed_cache_size
+        ) if seed_key and self.settings.pdflatex_seed_cache_size > 0 else None
+        self._re_rerun = re.compile(rb"\bRerun\b")
 
-    async def _create(self):
+    async def _create(self, draft: bool = False):
         """
         Creates the LaTex sources based on the given data.
+
+        :param draft: bool, if True, pdflatex only updates the auxiliary files and neither reads images nor writes the
+        PDF file.
         """
         # Launch the pdflatex process
         arguments = list(self.settings.pdflatex_arguments)
+        if draft:
+            arguments.append("-draftmode")
+        environment = None
+        if self.format_file:
+            # The static preamble is loaded from the precompiled format file.
+            arguments.append(f"-fmt={os.path.splitext(os.path.basename(self.format_file))[0]}")
+            environment = dict(os.environ)
+            environment["TEXFORMATS"] = f"{os.path.dirname(self.format_file)}{os.pathsep}"
         arguments += [
             "-no-shell-escape",
             "-no-shell-restricted",
@@ -74,9 +120,13 @@ class ReportCreator(ReportCreatorBase):
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            cwd=self.work_dir
+            cwd=self.work_dir,
+            env=environment
         )
         await asyncio.wait_for(process.communicate(), timeout=self.pdflatex_timeout)
+        # In draft mode, no PDF file is written.
+        if draft:
+            return
         # Cancel the task to write newlines after the process finishes
         if not os.path.isfile(self.pdf_file):
             raise PdfLatexCompilationException(f"PDF file '{self.pdf_file}' was not found.")
@@ -89,12 +139,188 @@ class ReportCreator(ReportCreatorBase):
         """
         if not os.path.isfile(self.pdflatex):
             raise FileNotFoundError(f"pdflatex file '{self.pdflatex}' not found.")
+        if self.settings.pdflatex_precompile_format:
+            # The format is only created, if it does not exist for the current template yet (e.g., template change).
+            self.format_file = await run_blocking(
+                self.create_format, self.settings, self.info.project.report.version
+            )
+        # The configured number of iterations is an upper bound. We stop as soon as the auxiliary files are stable.
+        # Passes run in draft mode (no images, no PDF output) until the auxiliary files are stable. Afterward, a
+        # final pass in normal mode creates the PDF file. The last possible pass always runs in normal mode.
+        # If we are seeded with the auxiliary files of the previous build, we expect the first pass to converge and
+        # therefore run it in normal mode.
+        seeded = await run_blocking(self._load_auxiliary_files)
+        converged = False
+        auxiliary_files = self._get_auxiliary_files()
+        self.passes = 0
         for i in range(self.pdflatex_iterations):
+            draft = not converged and not (seeded and i == 0) and i < self.pdflatex_iterations - 1
             await self.notify(
                 message=f"Compiling PDF file for {self.title} ({i + 1}/{self.pdflatex_iterations})",
                 status=ReportCreationStatus.generating
             )
-            await self._create()
+            await self._create(draft=draft)
+            self.passes += 1
+            previous_auxiliary_files = auxiliary_files
+            auxiliary_files = self._get_auxiliary_files()
+            converged = auxiliary_files == previous_auxiliary_files and not self._rerun_requested()
+            if converged and not draft:
+                break
+        if converged:
+            self._logger.info(f"PDF file for {self.title} converged after {self.passes} pdflatex pass(es)"
+                              f"{' (seeded)' if seeded else ''}.")
+        else:
+            self._logger.warning(f"PDF file for {self.title} did not converge within {self.passes} pdflatex pass(es).")
+        await run_blocking(self._save_auxiliary_files)
+
+    def _load_auxiliary_files(self) -> bool:
+        """
+        Copies the auxiliary files of the previous build into the work directory.
+
+        :return: True, if the auxiliary files of a previous build were found.
+        """
+        if not self.seed_cache:
+            return False
+        base_name = os.path.splitext(self.tex_file)[0]
+        result = False
+        for extension in self.AUXILIARY_EXTENSIONS:
+            file_name = f"{base_name}{extension}"
+            content = self.seed_cache.get(FileCache.get_key(self.seed_key, extension))
+            if content is not None:
+                with open(file_name, "wb") as file:
+                    file.write(content)
+                result = result or extension == ".aux"
+        return result
+
+    def _save_auxiliary_files(self):
+        """
+        Persists the auxiliary files of this build for the next build with the same seed key.
+        """
+        if not self.seed_cache:
+            return
+        base_name = os.path.splitext(self.tex_file)[0]
+        for extension in self.AUXILIARY_EXTENSIONS:
+            file_name = f"{base_name}{extension}"
+            if os.path.isfile(file_name):
+                with open(file_name, "rb") as file:
+                    self.seed_cache.put(FileCache.get_key(self.seed_key, extension), file.read(), replace=True)
+
+    def _get_auxiliary_files(self) -> Dict[str, str]:
+        """
+        Returns the hashes of the auxiliary files that pdflatex reads in the next pass.
+        """
+        result = {}
+        base_name = os.path.splitext(self.tex_file)[0]
+        for extension in self.AUXILIARY_EXTENSIONS:
+            file_name = f"{base_name}{extension}"
+            if os.path.isfile(file_name):
+                with open(file_name, "rb") as file:
+                    result[extension] = hashlib.sha256(file.read()).hexdigest()
+        return result
+
+    def _rerun_requested(self) -> bool:
+        """
+        Returns True, if the log file of the last pass asks for another pass (e.g., label or table width changes).
+        """
+        if not os.path.isfile(self.log_file):
+            return False
+        with open(self.log_file, "rb") as file:
+            return self._re_rerun.search(file.read()) is not None
+
+    @staticmethod
+    def get_format_file(settings: Settings, version: ReportTemplateFileVersion) -> str:
+        """
+        Returns the path of the format file for the given template version. The file name contains the hash of the
+        Latex template file as well as pdflatex, so that changes automatically result in a new format file.
+        """
+        template_file = settings.get_latex_template_file(version)
+        with open(template_file, "rb") as file:
+            digest = hashlib.sha256(file.read())
+        digest.update(os.path.realpath(settings.pdflatex_file).encode("utf-8"))
+        return os.path.join(
+            settings.get_cache_directory("formats"),
+            f"guardian-{version.name}-{digest.hexdigest()[:16]}.fmt"
+        )
+
+    @staticmethod
+    def create_format(settings: Settings, version: ReportTemplateFileVersion) -> str | None:
+        """
+        Precompiles the static preamble of the given template version (everything before \\endofdump) into a format
+        file using the mylatexformat package.
+
+        :return: The path of the format file or None, if the format file could not be created.
+        """
+        try:
+            format_file = ReportCreator.get_format_file(settings, version)
+            with _format_lock:
+                if os.path.isfile(format_file):
+                    return format_file
+                format_dir = os.path.dirname(format_file)
+                job_name = os.path.splitext(os.path.basename(format_file))[0]
+                template_dir = settings.get_latex_template_directory(version)
+                os.makedirs(format_dir, exist_ok=True)
+                with tempfile.TemporaryDirectory(dir=format_dir) as temp_dir:
+                    arguments = list(settings.pdflatex_arguments)
+                    arguments += [
+                        "-ini",
+                        f"-jobname={job_name}",
+                        "-no-shell-escape",
+                        "-interaction=nonstopmode",
+                        "-halt-on-error",
+                        "-output-directory",
+                        temp_dir,
+                        "&pdflatex",
+                        "mylatexformat.ltx",
+                        settings.latex_template_file
+                    ]
+                    logger.debug(f"Creating format file with arguments: {' '.join(arguments)}")
+                    subprocess.run(
+                        [settings.pdflatex_file, *arguments],
+                        stdin=subprocess.DEVNULL,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                        cwd=template_dir,
+                        timeout=settings.pdflatex_timeout,
+                        check=True
+                    )
+                    temp_file = os.path.join(temp_dir, os.path.basename(format_file))
+                    if not os.path.isfile(temp_file) or os.stat(temp_file).st_size == 0:
+                        raise PdfLatexCompilationException(f"Format file '{temp_file}' was not created.")
+                    shutil.move(temp_file, format_file)
+            logger.info(f"Created format file '{format_file}' for template version {version.name}.")
+            return format_file
+        except Exception as ex:
+            logger.warning(f"Format file for template version {version.name} could not be created. Compiling "
+                           f"without format file.")
+            logger.exception(ex)
+        return None
+
+    def split_pdf(self, marker: str, count: int) -> List[bytes]:
+        """
+        Splits the created PDF file at the start pages, which were recorded in the aux file as
+        \\@gobbletwo{<marker>:<index>}{<page>}.
+
+        :param marker: str, the marker used in the aux file.
+        :param count: int, the number of expected parts.
+        :return: The PDF file of each part.
+        """
+        with open(f"{os.path.splitext(self.tex_file)[0]}.aux", "r", encoding="utf-8", errors="replace") as file:
+            pattern = re.compile(rf"\\@gobbletwo\{{{re.escape(marker)}:(\d+)\}}\{{(\d+)\}}")
+            start_pages = {int(index): int(page) for index, page in pattern.findall(file.read())}
+        start_pages = [start_pages.get(i) for i in range(count)]
+        if None in start_pages or start_pages != sorted(set(start_pages)):
+            raise PdfLatexCompilationException(f"Invalid page markers in aux file: {start_pages}")
+        reader = PdfReader(self.pdf_file)
+        end_pages = [item - 1 for item in start_pages[1:]] + [len(reader.pages)]
+        result = []
+        for start, end in zip(start_pages, end_pages):
+            writer = PdfWriter()
+            for i in range(start - 1, end):
+                writer.add_page(reader.pages[i])
+            with BytesIO() as content:
+                writer.write(content)
+                result.append(content.getvalue())
+        return result
 
     def get_pdf(self) -> bytes:
         """
@@ -119,3 +345,7 @@ class ReportCreator(ReportCreatorBase):
         """
         if not os.path.isfile(settings.pdflatex_file):
             raise FileNotFoundError(f"pdflatex file '{settings.pdflatex_file}' not found.")
+        # Precompile the static preamble of all template versions.
+        if settings.pdflatex_precompile_format:
+            for version in ReportTemplateFileVersion:
+                ReportCreator.create_format(settings, version)
@@ -0,0 +1,223 @@
+# This file is part of Guardian.
+#
+# Guardian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Guardian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Guardian. If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import logging
+from functools import lru_cache
+from collections.abc import Mapping
+from typing import Any, Callable, Dict, Iterator, List
+
+__author__ = "Lukas Reiter"
+__copyright__ = "Copyright (C) 2024 Lukas Reiter"
+__license__ = "GPLv3"
+
+logger = logging.getLogger(__name__)
+
+
+class PlaceholderNode:
+    """
+    A placeholder of a compiled template together with its already parsed parameters.
+    """
+    __slots__ = ("name", "params", "text")
+
+    def __init__(self, name: str, params: Dict[str, str], text: str):
+        """
+        :param name: str, the name of the placeholder (without escape characters).
+        :param params: dict, the parameters of the placeholder.
+        :param text: str, the matched placeholder string.
+        """
+        self.name = name
+        self.params = params
+        self.text = text
+
+    @staticmethod
+    def parse_parameters(params: str | None) -> Dict[str, str]:
+        """
+        Parses the parameters of a placeholder (e.g., key1=value1;key2=value2).
+        """
+        param_dict = {}
+        try:
+            if params:
+                for param in [item.strip() for item in params.split(';')]:
+                    key, value = param.split('=')
+                    param_dict[key.strip()] = value.strip()
+        except ValueError as ex:
+            logger.exception(ex)
+            raise ValueError(f"Invalid parameter format due to missing semicolon in: {params}")
+        return param_dict
+
+
+class CompiledTemplate:
+    """
+    A report text, which was split into literal chunks and placeholder nodes. As report templates share the same
+    texts (e.g., prefix and postfix sections or the executive summary), the texts are parsed only once and rendering
+    just joins the chunks.
+    """
+    def __init__(self, text: str, pattern: re.Pattern):
+        """
+        :param text: str, the report text containing placeholders.
+        :param pattern: re.Pattern, the pattern to match placeholders.
+        """
+        self.chunks: List[str | PlaceholderNode] = []
+        position = 0
+        for match in pattern.finditer(text):
+            if match.start() > position:
+                self.chunks.append(text[position:match.start()])
+            self.chunks.append(PlaceholderNode(
+                name=match.group(1).replace("\\", ""),
+                params=PlaceholderNode.parse_parameters(match.group(2)),
+                text=match.group(0)
+            ))
+            position = match.end()
+        if position < len(text):
+            self.chunks.append(text[position:])
+        self.placeholders = [item for item in self.chunks if isinstance(item, PlaceholderNode)]
+
+    def render(
+            self,
+            placeholder_values: Dict[str, str],
+            placeholder_fn: Callable[[str, Dict[str, str], str, str | None], str | None]
+    ) -> str:
+        """
+        Replaces the placeholders with the values returned by the given placeholder function.
+
+        :param placeholder_values: dict, dictionary containing placeholder values.
+        :param placeholder_fn: function, a function that generates the final value for placeholders.
+        :return: str, the final text with placeholders replaced.
+        """
+        if not self.placeholders:
+            return "".join(self.chunks)
+        result = []
+        for item in self.chunks:
+            if isinstance(item, str):
+                result.append(item)
+                continue
+            # The parameters are copied, so that placeholder functions cannot modify the cached template.
+            value = placeholder_fn(item.name, dict(item.params), item.text, placeholder_values.get(item.name))
+            if value is not None:
+                result.append(value)
+        return "".join(result)
+
+
+@lru_cache(maxsize=512)
+def compile_template(text: str, pattern: re.Pattern) -> CompiledTemplate:
+    """
+    Returns the compiled template of the given text. The compiled templates are cached by the hash of the text.
+    """
+    return CompiledTemplate(text, pattern)
+
+
+class PlaceholderProvider:
+    """
+    Computes the value of a placeholder for a report creator.
+    """
+    __slots__ = ("name", "function", "condition")
+
+    def __init__(self, name: str, function: Callable[[Any], Any], condition: Callable[[Any], Any] | None = None):
+        """
+        :param name: str, the name of the placeholder.
+        :param function: function, returns the value of the placeholder for the given report creator.
+        :param condition: function, returns whether the placeholder is available for the given report creator.
+        """
+        self.name = name
+        self.function = function
+        self.condition = condition
+
+
+class PlaceholderRegistry:
+    """
+    This class holds the placeholder providers. The values are not computed by the registry itself but by the
+    PlaceholderValues returned by bind, which evaluate a provider only when its placeholder is referenced.
+    """
+    def __init__(self, providers: List[PlaceholderProvider] | None = None):
+        self._providers: Dict[str, PlaceholderProvider] = {item.name: item for item in providers or []}
+
+    def add(self, name: str, function: Callable[[Any], Any], condition: Callable[[Any], Any] | None = None):
+        """
+        Registers (or replaces) the provider of the given placeholder.
+        """
+        self._providers[name] = PlaceholderProvider(name=name, function=function, condition=condition)
+
+    def register(self, name: str, condition: Callable[[Any], Any] | None = None):
+        """
+        Decorator, which registers the decorated function as provider of the given placeholder.
+        """
+        def decorator(function: Callable[[Any], Any]):
+            self.add(name, function, condition)
+            return function
+        return decorator
+
+    def remove(self, name: str):
+        self._providers.pop(name, None)
+
+    def copy(self) -> "PlaceholderRegistry":
+        """
+        Returns a copy of this registry, which can be extended without affecting this registry.
+        """
+        return PlaceholderRegistry(list(self._providers.values()))
+
+    def bind(self, creator: Any, sanitize: Callable[[str], str] | None = None) -> "PlaceholderValues":
+        """
+        Returns the lazily evaluated placeholder values of the given report creator.
+        """
+        return PlaceholderValues(creator, self._providers, sanitize)
+
+
+class PlaceholderValues(Mapping):
+    """
+    The placeholder values of a report creator. A value is computed, sanitized and memoized on first access. Providers
+    might access other placeholders through the creator's placeholders, which are then evaluated first.
+    """
+    def __init__(
+            self,
+            creator: Any,
+            providers: Dict[str, PlaceholderProvider],
+            sanitize: Callable[[str], str] | None = None
+    ):
+        self.creator = creator
+        self.sanitize = sanitize
+        self._providers = providers
+        self._available: Dict[str, bool] = {}
+        self._values: Dict[str, str] = {}
+        self._evaluating = set()
+
+    def __contains__(self, name: object) -> bool:
+        if name not in self._providers:
+            return False
+        if name not in self._available:
+            provider = self._providers[name]
+            self._available[name] = not provider.condition or bool(provider.condition(self.creator))
+        return self._available[name]
+
+    def __getitem__(self, name: str) -> str:
+        if name in self._values:
+            return self._values[name]
+        if name not in self:
+            raise KeyError(name)
+        if name in self._evaluating:
+            raise ValueError(f"Placeholder '{name}' depends on itself.")
+        self._evaluating.add(name)
+        try:
+            value = str(self._providers[name].function(self.creator))
+        finally:
+            self._evaluating.remove(name)
+        self._values[name] = self.sanitize(value) if self.sanitize else value
+        return self._values[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return (name for name in self._providers if name in self)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
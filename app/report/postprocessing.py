@@ -0,0 +1,63 @@
+# This file is part of Guardian.
+#
+# Guardian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Guardian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Guardian. If not, see <https://www.gnu.org/licenses/>.
+
+import re
+from typing import Dict, List, Tuple
+
+__author__ = "Lukas Reiter"
+__copyright__ = "Copyright (C) 2024 Lukas Reiter"
+__license__ = "GPLv3"
+
+
+class PostProcessor:
+    """
+    This class performs the post-processing of the Latex code returned by pandoc in a single pass.
+
+    All rules are combined into one precompiled alternation. Each match is dispatched to the rule that matched and
+    expanded with the rule's replacement. This is equivalent to applying the rules one after another, as long as the
+    matches of the rules cannot overlap and no replacement creates a new match, which holds for the rules below.
+    """
+    RULES = [
+        # Make sure URLs are underlined (at the moment Latex commands \url and \href are considered)
+        (r"\\href[\s\n]*\{", r"\\slink{"),
+        # Make sure that 1st, 2nd, 3rd, 4th, ... are formatted correctly
+        (r"([\s234567890]1)(st)", "\\1$^{st}$"),
+        (r"([\s234567890]2)(nd)", "\\1$^{nd}$"),
+        (r"([\s234567890]3)(rd)", "\\1$^{nd}$"),
+        (r"((\s11)|(\s12)|(\s13)|([4567890]))(th)", "\\1$^{th}$")
+    ]
+
+    def __init__(self, rules: List[Tuple[str, str]] | None = None):
+        """
+        :param rules: list, the (pattern, replacement) tuples in the order they would be applied by re.sub.
+        """
+        rules = rules if rules is not None else self.RULES
+        self._rules: Dict[str, Tuple[re.Pattern, str]] = {
+            f"rule{i}": (re.compile(pattern), replacement) for i, (pattern, replacement) in enumerate(rules)
+        }
+        self._pattern = re.compile("|".join(
+            f"(?P<{name}>{pattern.pattern})" for name, (pattern, _) in self._rules.items()
+        ))
+
+    def _replacement(self, match: re.Match) -> str:
+        pattern, replacement = self._rules[match.lastgroup]
+        # The rules do not use look-arounds or anchors, so matching the matched text alone yields the same groups.
+        return pattern.fullmatch(match.group(0)).expand(replacement)
+
+    def process(self, content: str) -> str:
+        """
+        Applies all rules to the given content.
+        """
+        return self._pattern.sub(self._replacement, content)
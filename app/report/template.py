@@ -0,0 +1,182 @@
+# This file is part of Guardian.
+#
+# Guardian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Guardian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Guardian. If not, see <https://www.gnu.org/licenses/>.
+
+import os
+import time
+import shutil
+import logging
+import tempfile
+import threading
+from typing import List
+from core.config import Settings
+from schema.reporting.report_template import ReportTemplateFileVersion
+from .cache import FileCache
+
+__author__ = "Lukas Reiter"
+__copyright__ = "Copyright (C) 2024 Lukas Reiter"
+__license__ = "GPLv3"
+
+logger = logging.getLogger(__name__)
+
+
+class TemplateBundle:
+    """
+    This class manages an immutable snapshot of a Latex template directory. Work directories are created as thin
+    overlays, whose files are hard links to the snapshot. Only the files generated by a job are written to its work
+    directory.
+    """
+    def __init__(self, source: str, cache_directory: str):
+        """
+        :param source: str, the Latex template directory.
+        :param cache_directory: str, the directory where the snapshots are stored.
+        """
+        self.source = source
+        self.cache_directory = cache_directory
+        self.signature = self.get_signature(source)
+        self.directory = self.get_directory(source, cache_directory, self.signature)
+        self.files = []
+        # Time at which the signature of the template directory was checked the last time
+        self.checked = time.monotonic()
+
+    @staticmethod
+    def get_directory(source: str, cache_directory: str, signature: str) -> str:
+        """
+        Returns the snapshot directory of the given template directory and signature.
+        """
+        return os.path.join(cache_directory, f"{os.path.basename(os.path.normpath(source))}-{signature[:16]}")
+
+    @staticmethod
+    def get_signature(source: str) -> str:
+        """
+        Returns a signature of the given directory, which changes as soon as a file is added, removed or modified.
+        """
+        parts = []
+        for root, _, files in sorted(os.walk(source)):
+            for file in sorted(files):
+                path = os.path.join(root, file)
+                stat = os.stat(path)
+                parts += [os.path.relpath(path, source), str(stat.st_size), str(stat.st_mtime_ns)]
+        return FileCache.get_key(*parts)
+
+    def load(self):
+        """
+        Creates the snapshot of the template directory, if it does not exist yet.
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.cache_directory, exist_ok=True)
+            # We copy to a temporary directory first, so that concurrent processes never see partial snapshots.
+            temp_dir = tempfile.mkdtemp(dir=self.cache_directory)
+            try:
+                shutil.copytree(self.source, temp_dir, dirs_exist_ok=True)
+                os.rename(temp_dir, self.directory)
+                logger.info(f"Created snapshot of Latex template directory '{self.source}'.")
+            except OSError:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+                if not os.path.isdir(self.directory):
+                    raise
+        self.files = self._get_files()
+
+    def create_overlay(self, work_dir: str, directories: List[str] | None = None):
+        """
+        Creates the given work directory and links all template files into it.
+
+        :param work_dir: str, the (not yet existing) work directory.
+        :param directories: list, additional directories, which are created inside the work directory.
+        """
+        os.makedirs(work_dir)
+        for file in self.files:
+            source = os.path.join(self.directory, file)
+            destination = os.path.join(work_dir, file)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            try:
+                os.link(source, destination)
+            except OSError:
+                # Hard links are not supported across file systems.
+                shutil.copy2(source, destination)
+        for directory in directories or []:
+            os.makedirs(os.path.join(work_dir, directory), exist_ok=True)
+
+    def _get_files(self) -> List[str]:
+        """
+        Returns the relative paths of all files of the snapshot.
+        """
+        result = []
+        for root, _, files in os.walk(self.directory):
+            result += [os.path.relpath(os.path.join(root, file), self.directory) for file in files]
+        return sorted(result)
+
+
+def detach_file(path: str, keep_content: bool = True):
+    """
+    Makes sure that the given file is not shared with the template snapshot, before it is modified.
+
+    :param path: str, the file, which is going to be modified.
+    :param keep_content: bool, if False, the shared file is just removed (e.g., because it is overwritten anyway).
+    """
+    if not os.path.isfile(path) or os.stat(path).st_nlink <= 1:
+        return
+    if not keep_content:
+        os.remove(path)
+        return
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(path), delete=False) as file:
+        with open(path, "rb") as source:
+            shutil.copyfileobj(source, file)
+    shutil.copymode(path, file.name)
+    os.replace(file.name, path)
+
+
+_bundles = {}
+_bundles_lock = threading.Lock()
+
+
+def get_template_bundle(settings: Settings, version: ReportTemplateFileVersion) -> TemplateBundle:
+    """
+    Returns the process-wide template bundle for the given version. The template directory is checked for changes at
+    most once per TEMPLATE_CHECK_INTERVAL and the snapshot is recreated, if it has changed.
+
+    Outdated snapshots are not removed here, because running jobs might still create overlays from them (see
+    remove_outdated_snapshots).
+    """
+    source = settings.get_latex_template_directory(version)
+    with _bundles_lock:
+        bundle = _bundles.get(source)
+        if bundle and time.monotonic() - bundle.checked < settings.template_check_interval:
+            return bundle
+        if not bundle or bundle.signature != TemplateBundle.get_signature(source):
+            bundle = TemplateBundle(source=source, cache_directory=settings.get_cache_directory("templates"))
+            bundle.load()
+            _bundles[source] = bundle
+        bundle.checked = time.monotonic()
+        return bundle
+
+
+def remove_outdated_snapshots(settings: Settings):
+    """
+    Removes all snapshots, which do not belong to the current template directories. This function must only be called
+    at startup, when no job is using a snapshot.
+    """
+    cache_directory = settings.get_cache_directory("templates")
+    if not os.path.isdir(cache_directory):
+        return
+    current = set()
+    for version in ReportTemplateFileVersion:
+        source = settings.get_latex_template_directory(version)
+        if os.path.isdir(source):
+            current.add(TemplateBundle.get_directory(source, cache_directory, TemplateBundle.get_signature(source)))
+    for item in os.listdir(cache_directory):
+        path = os.path.join(cache_directory, item)
+        if path not in current:
+            logger.info(f"Removing outdated template snapshot '{path}'.")
+            shutil.rmtree(path, ignore_errors=True)
@@ -15,27 +15,36 @@
 
 import os
 import re
-import shutil
 import logging
-import tempfile
+import zipfile
 import platform
-from typing import Dict, Any, List, Callable
+from io import BytesIO
+from typing import Dict, Any, List, Callable, BinaryIO, Mapping
 from core.config import Settings
 from schema import ReportGenerationInfo
 from schema.user import ReportRequestor
 from schema.logging import InjectingFilter
 from schema.reporting import ReportCreationStatus
 from schema.reporting.report_language import ReportLanguageReport
+from .postprocessing import PostProcessor
+from .placeholder import compile_template, PlaceholderRegistry, PlaceholderValues
 
 __author__ = "Lukas Reiter"
 __copyright__ = "Copyright (C) 2024 Lukas Reiter"
 __license__ = "GPLv3"
 
+POST_PROCESSOR = PostProcessor()
+# Providers of the placeholders available in all reports (see the end of this module).
+PLACEHOLDERS = PlaceholderRegistry()
+
 
 class ReportCreatorBase:
     """
     Base class used for creating reports.
     """
+    STORED_EXTENSIONS = [".png", ".jpg", ".jpeg", ".gif", ".pdf", ".zip", ".gz", ".xlsx", ".docx"]
+    # Subclasses can provide additional placeholders by using a copy of this registry.
+    placeholder_registry = PLACEHOLDERS
 
     def __init__(
             self,
@@ -56,12 +65,7 @@ class ReportCreatorBase:
         self._logger = logging.getLogger(__name__)
         self._logger.addFilter(InjectingFilter(self.info.requestor))
         self._placeholders = None
-        self._re_numbering = {
-            r"([\s234567890]1)(st)": "\\1$^{st}$",
-            r"([\s234567890]2)(nd)": "\\1$^{nd}$",
-            r"([\s234567890]3)(rd)": "\\1$^{nd}$",
-            r"((\s11)|(\s12)|(\s13)|([4567890]))(th)": "\\1$^{th}$"
-        }
+        self._post_processor = POST_PROCESSOR
         self.pre_placeholder_pattern = re.compile(r"\{\{\.(\w+)(?::([\w\\\.:\-\s=\(\),;]+))?\}\}")
         self._is_windows = platform.system().lower() == "windows"
 
@@ -70,66 +74,20 @@ class ReportCreatorBase:
         return self.project.report
 
     @property
-    def placeholders(self) -> Dict[str, str]:
-        """
-        This method returns the placeholders.
-        """
-        def get_date(x: str):
-            return f"{x:%B %#d, %Y}" if self._is_windows else f"{x:%B %-d, %Y}"
-        if not self._placeholders:
-            self._placeholders = {
-                "classification": self.report_classification,
-                "project_id": self.project.project_id,
-                "project_name": self.project.name,
-                "project_type": self.project.project_type.name.replace("_", " ").lower(),
-                "project_start_date": f"{self.project.start_date:%B %-d, %Y}",
-                "vulnerability_counts": self.severity_distribution_str,
-                "application_names": self.join_list(
-                    self.project.report.report_language,
-                    self.project.applications,
-                    join_fn=lambda language, item: f"{item.name} ({item.application_id})"
-                ) or "n/a",
-                "test_reasons": self.join_list(
-                    self.project.report.report_language,
-                    self.project.reasons,
-                    join_fn=lambda language, item: item.name,
-                    separator=" "
-                ) or "n/a",
-                "test_environments": self.join_list(
-                    self.project.report.report_language,
-                    self.project.environments,
-                    join_fn=lambda language, item: item.name
-                ) or "n/a",
-                "assessors": self.assessors,
-                "test_location": self.project.location.name,
-            }
-            if self.file_name:
-                self._placeholders["pdf_file_name"] = self.pdf_file_name
-                self._placeholders["xlsx_file_name"] = self.xlsx_file_name
-            if self.testing_days:
-                self._placeholders["test_days"] = str(self.testing_days)
-            if self.latest_version_info:
-                self._placeholders["report_version"] = str(self.latest_version_info.version)
-                self._placeholders["report_status"] = self.latest_version_info.status.name.capitalize()
-                self._placeholders["delivery_date"] = self.delivery_date
-            if self.project.end_date:
-                self._placeholders["project_end_date"] = get_date(self.project.end_date)
-                self._placeholders["test_period"] = self.test_period
-            if self.project.lead_tester:
-                self._placeholders["lead_tester_name"] = self.project.lead_tester.full_name
-            if self.project.manager:
-                self._placeholders["manager_name"] = self.project.manager.full_name
-            if self.project.provider:
-                self._placeholders["provider_name"] = self.project.provider.name
-                self._placeholders["provider_short"] = self.project.provider.abbreviation
-                self._placeholders["provider_address"] = self.project.provider.address
-            if self.project.provider:
-                self._placeholders["customer_name"] = self.project.customer.name
-                self._placeholders["customer_short"] = self.project.customer.abbreviation
-                self._placeholders["customer_address"] = self.project.customer.address
-            self._placeholders = {key: str(value) for key, value in self._placeholders.items()}
+    def placeholders(self) -> PlaceholderValues:
+        """
+        This method returns the placeholders. The values are only computed, when they are referenced.
+        """
+        if self._placeholders is None:
+            self._placeholders = self.placeholder_registry.bind(self, sanitize=self.sanitize_placeholder)
         return self._placeholders
 
+    def sanitize_placeholder(self, value: str) -> str:
+        """
+        Sanitizes the value of a placeholder, before it is used in the report.
+        """
+        return value
+
     @property
     def file_name(self) -> str:
         """
@@ -260,24 +218,49 @@ class ReportCreatorBase:
             return f"{separator.join(result[:-1])}, and {result[-1]}"
 
     @staticmethod
-    def create_zip(source: str) -> bytes | None:
+    def create_zip(
+            source: str,
+            files: List[str] | None = None,
+            compression_level: int = 6,
+            target: BinaryIO | None = None
+    ) -> bytes | None:
         """
         This method creates and returns a ZIP file.
+
+        :param source: str, the directory whose content is archived.
+        :param files: list, the paths (relative to source) of the files to archive. If None, all files are archived.
+        :param compression_level: int, the compression level (0-9) of files that are not compressed already.
+        :param target: file object, if given, the ZIP file is written into it and None is returned.
         """
         if not os.path.isdir(source):
             raise NotADirectoryError(f"The source '{source}' is not a directory.")
-        with tempfile.NamedTemporaryFile(suffix=".zip") as file:
-            file_name = os.path.splitext(file.name)[0]
-            shutil.make_archive(file_name, "zip", source)
-            with open(file.name, "rb") as content:
-                result = content.read()
-        return result
+        if files is None:
+            files = []
+            for root, _, names in os.walk(source):
+                files += [os.path.relpath(os.path.join(root, name), source) for name in names]
+        buffer = target or BytesIO()
+        with zipfile.ZipFile(buffer, "w") as archive:
+            for file in sorted(files):
+                path = os.path.join(source, file)
+                if not os.path.isfile(path):
+                    continue
+                # Compressing already compressed files costs time without reducing their size.
+                if os.path.splitext(file)[1].lower() in ReportCreatorBase.STORED_EXTENSIONS:
+                    archive.write(path, arcname=file, compress_type=zipfile.ZIP_STORED)
+                else:
+                    archive.write(
+                        path,
+                        arcname=file,
+                        compress_type=zipfile.ZIP_DEFLATED,
+                        compresslevel=compression_level
+                    )
+        return None if target else buffer.getvalue()
 
     def replace_placeholders(
             self,
             report_text: str,
             placeholder_pattern: re.Pattern,
-            placeholder_values: Dict[str, str],
+            placeholder_values: Mapping[str, str],
             placeholder_fn: Callable[[str, Dict[str, str], str, str | None], str | None]
     ) -> str:
         """
@@ -290,30 +273,13 @@ class ReportCreatorBase:
         :param placeholder_fn: function, a function that generates the final value for placeholders.
         :return: str, the final text with placeholders replaced.
         """
-        def parse_parameters(params: str) -> Dict[str, str]:
-            """
-            Parses the parameters of a placeholder.
-            """
-            param_dict = {}
-            try:
-                if params:
-                    for param in [item.strip() for item in params.split(';')]:
-                        key, value = param.split('=')
-                        param_dict[key.strip()] = value.strip()
-            except ValueError as ex:
-                self._logger.exception(ex)
-                raise ValueError(f"Invalid parameter format due to missing semicolon in: {params}")
-            return param_dict
-
-        def replacement(match: re.Match) -> str:
-            placeholder_name = match.group(1).replace("\\", "")
-            params = parse_parameters(match.group(2))
-            if placeholder_name not in placeholder_values:
-                self._logger.debug(f"Placeholder {placeholder_name} cannot be resolved via list: "
+        # The text is parsed only once and the compiled template is reused by all reports sharing the same text.
+        template = compile_template(report_text, placeholder_pattern)
+        for placeholder in template.placeholders:
+            if placeholder.name not in placeholder_values:
+                self._logger.debug(f"Placeholder {placeholder.name} cannot be resolved via list: "
                                    f"{placeholder_values.keys}")
-            final_name = placeholder_values.get(placeholder_name)
-            return placeholder_fn(placeholder_name, params, match.group(0), final_name)
-        return placeholder_pattern.sub(replacement, report_text)
+        return template.render(placeholder_values, placeholder_fn)
 
     def replace_placeholders_only_func(
             self,
@@ -357,14 +323,8 @@ class ReportCreatorBase:
         Placeholder function that performs post-processing on the final value.
         :return:
         """
-        # Make sure URLs are underlined (at the moment Latex commands \url and \href are considered)
-        result = re.sub("\\\\href[\\s\\n]*\\{", "\\\\slink{", content)
-        for pattern, repl in self._re_numbering.items():
-            result = re.sub(pattern=pattern, repl=repl, string=result)
-        # Make sure that 1st, 2nd, 3rd, 4th, ... are formatted correctly
-        for pattern, repl in self._re_numbering.items():
-            result = re.sub(pattern=pattern, repl=repl, string=result)
-        return result
+        # Make sure URLs are underlined and that 1st, 2nd, 3rd, 4th, ... are formatted correctly (see PostProcessor)
+        return self._post_processor.process(content)
 
     def create(self):
         """
@@ -384,3 +344,100 @@ class ReportCreatorBase:
         Checks prerequisites for creating the report.
         """
         raise NotImplementedError()
+
+
+def _get_date(creator: ReportCreatorBase, value) -> str:
+    return f"{value:%B %#d, %Y}" if creator._is_windows else f"{value:%B %-d, %Y}"
+
+
+PLACEHOLDERS.add("classification", lambda creator: creator.report_classification)
+PLACEHOLDERS.add("project_id", lambda creator: creator.project.project_id)
+PLACEHOLDERS.add("project_name", lambda creator: creator.project.name)
+PLACEHOLDERS.add(
+    "project_type",
+    lambda creator: creator.project.project_type.name.replace("_", " ").lower()
+)
+PLACEHOLDERS.add("project_start_date", lambda creator: f"{creator.project.start_date:%B %-d, %Y}")
+PLACEHOLDERS.add("vulnerability_counts", lambda creator: creator.severity_distribution_str)
+PLACEHOLDERS.add("application_names", lambda creator: creator.join_list(
+    creator.project.report.report_language,
+    creator.project.applications,
+    join_fn=lambda language, item: f"{item.name} ({item.application_id})"
+) or "n/a")
+PLACEHOLDERS.add("test_reasons", lambda creator: creator.join_list(
+    creator.project.report.report_language,
+    creator.project.reasons,
+    join_fn=lambda language, item: item.name,
+    separator=" "
+) or "n/a")
+PLACEHOLDERS.add("test_environments", lambda creator: creator.join_list(
+    creator.project.report.report_language,
+    creator.project.environments,
+    join_fn=lambda language, item: item.name
+) or "n/a")
+PLACEHOLDERS.add("assessors", lambda creator: creator.assessors)
+PLACEHOLDERS.add("test_location", lambda creator: creator.project.location.name)
+PLACEHOLDERS.add("pdf_file_name", lambda creator: creator.pdf_file_name, condition=lambda creator: creator.file_name)
+PLACEHOLDERS.add("xlsx_file_name", lambda creator: creator.xlsx_file_name, condition=lambda creator: creator.file_name)
+PLACEHOLDERS.add("test_days", lambda creator: creator.testing_days, condition=lambda creator: creator.testing_days)
+PLACEHOLDERS.add(
+    "report_version",
+    lambda creator: creator.latest_version_info.version,
+    condition=lambda creator: creator.latest_version_info
+)
+PLACEHOLDERS.add(
+    "report_status",
+    lambda creator: creator.latest_version_info.status.name.capitalize(),
+    condition=lambda creator: creator.latest_version_info
+)
+PLACEHOLDERS.add(
+    "delivery_date",
+    lambda creator: creator.delivery_date,
+    condition=lambda creator: creator.latest_version_info
+)
+PLACEHOLDERS.add(
+    "project_end_date",
+    lambda creator: _get_date(creator, creator.project.end_date),
+    condition=lambda creator: creator.project.end_date
+)
+PLACEHOLDERS.add("test_period", lambda creator: creator.test_period, condition=lambda creator: creator.project.end_date)
+PLACEHOLDERS.add(
+    "lead_tester_name",
+    lambda creator: creator.project.lead_tester.full_name,
+    condition=lambda creator: creator.project.lead_tester
+)
+PLACEHOLDERS.add(
+    "manager_name",
+    lambda creator: creator.project.manager.full_name,
+    condition=lambda creator: creator.project.manager
+)
+PLACEHOLDERS.add(
+    "provider_name",
+    lambda creator: creator.project.provider.name,
+    condition=lambda creator: creator.project.provider
+)
+PLACEHOLDERS.add(
+    "provider_short",
+    lambda creator: creator.project.provider.abbreviation,
+    condition=lambda creator: creator.project.provider
+)
+PLACEHOLDERS.add(
+    "provider_address",
+    lambda creator: creator.project.provider.address,
+    condition=lambda creator: creator.project.provider
+)
+PLACEHOLDERS.add(
+    "customer_name",
+    lambda creator: creator.project.customer.name,
+    condition=lambda creator: creator.project.provider
+)
+PLACEHOLDERS.add(
+    "customer_short",
+    lambda creator: creator.project.customer.abbreviation,
+    condition=lambda creator: creator.project.provider
+)
+PLACEHOLDERS.add(
+    "customer_address",
+    lambda creator: creator.project.customer.address,
+    condition=lambda creator: creator.project.provider
+)
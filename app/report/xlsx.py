@@ -0,0 +1,293 @@
+# This file is part of Guardian.
+#
+# Guardian is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Guardian is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Guardian. If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import shutil
+import zipfile
+import posixpath
+from html import escape, unescape
+from typing import Any, Dict, Iterable, List, Tuple
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils.exceptions import IllegalCharacterError
+from openpyxl.utils import get_column_letter, column_index_from_string, range_boundaries
+
+__author__ = "Lukas Reiter"
+__copyright__ = "Copyright (C) 2024 Lukas Reiter"
+__license__ = "GPLv3"
+
+
+def get_column_ranges(column: int, rows: Iterable[int]) -> List[str]:
+    """
+    Returns the cell ranges covering the given rows of the given column. Consecutive rows are merged into a single
+    range (e.g., E2:E500).
+    """
+    result = []
+    letter = get_column_letter(column)
+    start = end = None
+    for row in sorted(set(rows)) + [None]:
+        if start is not None and row == end + 1:
+            end = row
+            continue
+        if start is not None:
+            result.append(f"{letter}{start}" if start == end else f"{letter}{start}:{letter}{end}")
+        start = end = row
+    return result
+
+
+class XlsxStreamWriter:
+    """
+    This class creates an Excel file by streaming the rows directly into the sheet XML of the template file. In
+    contrast to openpyxl, it neither builds an object model of the workbook nor copies style objects. New cells
+    reference the style indices of the template row.
+
+    The layout of the rows is identical to the one created by the openpyxl engine of the Excel report creator.
+    """
+    RELATIONSHIP_TABLE = "/relationships/table"
+    re_attribute = re.compile(r'([\w:]+)\s*=\s*"([^"]*)"')
+    re_sheet = re.compile(r"<(?:\w+:)?sheet\b[^>]*>")
+    re_relationship = re.compile(r"<(?:\w+:)?Relationship\b[^>]*>")
+    re_sheet_data = re.compile(r"<sheetData\s*/>|<sheetData>(.*?)</sheetData>", re.DOTALL)
+    re_row = re.compile(r"<row\b[^>]*?(?:/>|>.*?</row>)", re.DOTALL)
+    re_cell = re.compile(r"<c\b[^>]*?(?:/>|>.*?</c>)", re.DOTALL)
+    re_start_tag = re.compile(r"^<\w+\b[^>]*?/?>")
+    re_dimension = re.compile(r"<dimension\b[^>]*/>")
+    re_data_validation = re.compile(r'(<dataValidation\b[^>]*\bsqref=")([^"]*)(")')
+    re_table_ref = re.compile(r'(<table\b[^>]*?\sref=")([^"]*)(")')
+    re_cell_reference = re.compile(r"([A-Z]+)(\d+)")
+
+    def __init__(self, template_file: str, sheet_name: str, table_name: str, template_row: int):
+        """
+        :param template_file: str, the Excel template file.
+        :param sheet_name: str, the name of the sheet containing the table.
+        :param table_name: str, the name of the table, which is populated.
+        :param template_row: int, the row (relative to the table header) whose styles are applied to new rows.
+        """
+        self.template_file = template_file
+        self.sheet_name = sheet_name
+        self.table_name = table_name
+        self.template_row = template_row
+
+    @classmethod
+    def get_attributes(cls, tag: str) -> Dict[str, str]:
+        """
+        Returns the attributes of the given XML start tag.
+        """
+        start_tag = cls.re_start_tag.match(tag).group(0)
+        return {key: unescape(value) for key, value in cls.re_attribute.findall(start_tag)}
+
+    @staticmethod
+    def get_target(base: str, target: str) -> str:
+        """
+        Resolves the target of a relationship relative to the given part.
+        """
+        if target.startswith("/"):
+            return target[1:]
+        return posixpath.normpath(posixpath.join(posixpath.dirname(base), target))
+
+    @staticmethod
+    def get_relationships_part(part: str) -> str:
+        return posixpath.join(posixpath.dirname(part), "_rels", f"{posixpath.basename(part)}.rels")
+
+    def get_relationships(self, archive: zipfile.ZipFile, part: str) -> Dict[str, Dict[str, str]]:
+        """
+        Returns the relationships of the given part.
+        """
+        name = self.get_relationships_part(part)
+        if name not in archive.namelist():
+            return {}
+        content = archive.read(name).decode("utf-8")
+        result = {}
+        for tag in self.re_relationship.findall(content):
+            attributes = self.get_attributes(tag)
+            attributes["Target"] = self.get_target(part, attributes["Target"])
+            result[attributes["Id"]] = attributes
+        return result
+
+    def get_parts(self, archive: zipfile.ZipFile) -> Tuple[str, str]:
+        """
+        Returns the names of the sheet part and the table part.
+        """
+        workbook = "xl/workbook.xml"
+        relationships = self.get_relationships(archive, workbook)
+        sheet_part = None
+        for tag in self.re_sheet.findall(archive.read(workbook).decode("utf-8")):
+            attributes = self.get_attributes(tag)
+            if attributes.get("name") == self.sheet_name:
+                sheet_part = relationships[attributes["r:id"]]["Target"]
+                break
+        if not sheet_part:
+            raise ValueError(f"Sheet '{self.sheet_name}' not found in Excel template file.")
+        for relationship in self.get_relationships(archive, sheet_part).values():
+            if not relationship["Type"].endswith(self.RELATIONSHIP_TABLE):
+                continue
+            table = self.get_attributes(archive.read(relationship["Target"]).decode("utf-8").split("?>")[-1].strip())
+            if self.table_name in [table.get("name"), table.get("displayName")]:
+                return sheet_part, relationship["Target"]
+        raise ValueError(f"Table '{self.table_name}' does not exist in sheet '{self.sheet_name}'.")
+
+    @classmethod
+    def parse_row(cls, row: str) -> Tuple[str, Dict[int, str]]:
+        """
+        Splits the given row element into its start tag and its cells (column index -> XML).
+        """
+        start_tag = cls.re_start_tag.match(row).group(0)
+        cells = {}
+        for cell in cls.re_cell.findall(row[len(start_tag):]):
+            column, _ = cls.re_cell_reference.match(cls.get_attributes(cell)["r"]).groups()
+            cells[column_index_from_string(column)] = cell
+        if start_tag.endswith("/>"):
+            start_tag = f"{start_tag[:-2]}>"
+        # The spans attribute is an optional hint, which might not be correct anymore.
+        return re.sub(r'\sspans="[^"]*"', "", start_tag), cells
+
+    @classmethod
+    def get_style(cls, cell: str | None) -> str | None:
+        """
+        Returns the style index of the given cell.
+        """
+        return cls.get_attributes(cell).get("s") if cell else None
+
+    @staticmethod
+    def set_style(cell: str, style: str) -> str:
+        """
+        Replaces the style index of the given cell.
+        """
+        start_tag = XlsxStreamWriter.re_start_tag.match(cell).group(0)
+        new_tag = re.sub(r'\ss="[^"]*"', "", start_tag).replace("<c ", f'<c s="{style}" ', 1)
+        return new_tag + cell[len(start_tag):]
+
+    @staticmethod
+    def contains(sqref: str, column: int, row: int) -> bool:
+        """
+        Returns True, if the given cell is part of the given (space-separated) cell ranges.
+        """
+        for cell_range in sqref.split():
+            min_col, min_row, max_col, max_row = range_boundaries(cell_range)
+            if min_col <= column <= max_col and min_row <= row <= max_row:
+                return True
+        return False
+
+    @staticmethod
+    def create_cell(reference: str, value: Any, style: str | None) -> str | None:
+        """
+        Returns the XML of a cell with the given value.
+        """
+        style = f' s="{style}"' if style and style != "0" else ""
+        # Like openpyxl, we do not write empty strings, so that the cell stays blank.
+        if value is None or value == "":
+            return f'<c r="{reference}"{style}/>' if style else None
+        if isinstance(value, bool):
+            return f'<c r="{reference}"{style} t="b"><v>{int(value)}</v></c>'
+        if isinstance(value, (int, float)):
+            return f'<c r="{reference}"{style}><v>{value}</v></c>'
+        value = str(value)
+        if ILLEGAL_CHARACTERS_RE.search(value):
+            raise IllegalCharacterError(f"{value} cannot be used in worksheets.")
+        return f'<c r="{reference}"{style} t="inlineStr"><is><t xml:space="preserve">{escape(value, quote=False)}' \
+               f'</t></is></c>'
+
+    @staticmethod
+    def create_row(start_tag: str, cells: Dict[int, str]) -> str:
+        """
+        Returns the XML of a row with the given cells.
+        """
+        return f"{start_tag}{''.join(cells[column] for column in sorted(cells))}</row>"
+
+    def write(self, excel_file: str, rows: Iterable[List[Any]]):
+        """
+        Creates the given Excel file and populates the table with the given rows.
+        """
+        with zipfile.ZipFile(self.template_file) as source, \
+                zipfile.ZipFile(excel_file, "w", compression=zipfile.ZIP_DEFLATED) as target:
+            sheet_part, table_part = self.get_parts(source)
+            sheet = source.read(sheet_part).decode("utf-8")
+            table = source.read(table_part).decode("utf-8")
+            from_x, from_y, to_x, to_y = range_boundaries(self.re_table_ref.search(table).group(2))
+            match = self.re_sheet_data.search(sheet)
+            if not match:
+                raise ValueError(f"Sheet '{self.sheet_name}' does not contain any data.")
+            existing = {}
+            for item in self.re_row.findall(match.group(1) or ""):
+                existing[int(self.get_attributes(item)["r"])] = self.parse_row(item)
+            pending = sorted(existing)
+            # The styles and data validations of the template row are applied to the new rows.
+            template_cells = existing.get(from_y + self.template_row, ("", {}))[1]
+            styles = {column: style for column in range(from_x, to_x + 1)
+                      if (style := self.get_style(template_cells.get(column)))}
+            validations = [
+                (item, [column for column in range(from_x, to_x + 1)
+                        if self.contains(item.group(2), column, self.template_row)])
+                for item in self.re_data_validation.finditer(sheet)
+            ]
+            styled_rows = []
+            with target.open(sheet_part, "w") as file:
+                def write_row(number: int, values: Dict[int, Any] | None = None, styled: bool = False):
+                    # Rows of the template, which precede the given row, are kept as they are.
+                    while pending and pending[0] < number:
+                        file.write(self.create_row(*existing[pending.pop(0)]).encode("utf-8"))
+                    if pending and pending[0] == number:
+                        start_tag, cells = existing[pending.pop(0)]
+                    else:
+                        start_tag, cells = f'<row r="{number}">', {}
+                    cells = dict(cells)
+                    for column, value in (values or {}).items():
+                        cell = self.create_cell(
+                            f"{get_column_letter(column)}{number}",
+                            value,
+                            self.get_style(cells.get(column))
+                        )
+                        if cell:
+                            cells[column] = cell
+                        else:
+                            cells.pop(column, None)
+                    if styled:
+                        for column, style in styles.items():
+                            cells[column] = self.set_style(
+                                cells.get(column, f'<c r="{get_column_letter(column)}{number}"/>'),
+                                style
+                            )
+                        styled_rows.append(number)
+                    if cells or number in existing:
+                        file.write(self.create_row(start_tag, cells).encode("utf-8"))
+
+                # The dimension precedes the sheet data and can therefore not be updated while streaming. As it is
+                # optional, we remove it, so that readers do not rely on an outdated value.
+                file.write(self.re_dimension.sub("", sheet[:match.start()]).encode("utf-8"))
+                file.write(b"<sheetData>")
+                row = from_y + 1
+                for values in rows:
+                    write_row(row, values={1 + x: value for x, value in enumerate(values)})
+                    row += 1
+                    # Apply formatting for all cells in current row
+                    write_row(row, styled=True)
+                    row += 1
+                while pending:
+                    file.write(self.create_row(*existing[pending.pop(0)]).encode("utf-8"))
+                file.write(b"</sheetData>")
+                tail = sheet[match.end():]
+                for item, columns in reversed(validations):
+                    cells = [cell_range for column in columns for cell_range in get_column_ranges(column, styled_rows)]
+                    if cells:
+                        start = item.start(2) - match.end()
+                        end = item.end(2) - match.end()
+                        tail = f"{tail[:start]}{' '.join([item.group(2)] + cells)}{tail[end:]}"
+                file.write(tail.encode("utf-8"))
+            # Update table definition
+            ref = f"{get_column_letter(from_x)}{from_y}:{get_column_letter(to_x)}{row - 1}"
+            target.writestr(table_part, self.re_table_ref.sub(rf"\g<1>{ref}\g<3>", table, count=1))
+            for item in source.infolist():
+                if item.filename not in [sheet_part, table_part]:
+                    with source.open(item) as reader, target.open(item, "w") as writer:
+                        shutil.copyfileobj(reader, writer)